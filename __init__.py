@@ -45,7 +45,7 @@ DPLSim: A Full Disease Gene Mapping Pipeline
 import DPLSim
 from DPLSim.analysisMethods import my_import
 
-__all__ = ['analysisMethods','format','replicator','loadHapMap3','simuGWAS','selectMarkers','singleGeneModel']
+__all__ = ['analysisMethods','format','replicator','loadHapMap3','simuGWAS','selectMarkers','singleGeneModel','geneticMap','hapStore','markerList']
 
 
 class AnalysisMethod(object):
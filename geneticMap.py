@@ -0,0 +1,73 @@
+"""
+Functions for handling the genetic map of a simuPOP population.
+
+The genetic map is saved in the local namespace of a population as an array
+'geneticMap' (array.array('d')) of genetic distances (in cM), one for each
+locus, in the order of locus indexes. Populations created by earlier versions
+of loadHapMap3.py save a list, or a dictionary keyed by marker names, instead,
+which is converted when the genetic map is accessed.
+
+mapOf: returns the genetic map of a population as an array.
+removeLoci: removes loci from a population together with their genetic map.
+recombinationRates: returns recombination rates between adjacent loci,
+	cached in the population as a dictionary 'recRates' keyed by intensity.
+"""
+
+from array import array
+
+def mapOf(pop):
+	"""
+	Return the genetic map of pop as an array aligned with locus indexes, or
+	None if pop does not have a genetic map. A genetic map saved as a list
+	or a dictionary of marker names is converted and saved back to pop.
+	"""
+	if not pop.vars().has_key('geneticMap'):
+		return None
+	gmap = pop.dvars().geneticMap
+	if type(gmap) == type({}):
+		gmap = [gmap[x] for x in pop.lociNames()]
+	if type(gmap) != array:
+		gmap = array('d', gmap)
+		pop.dvars().geneticMap = gmap
+	return gmap
+
+def removeLoci(pop, loci=[], keep=[]):
+	"""
+	Remove loci from pop, as pop.removeLoci(loci, keep) does, and remove
+	their distances from the genetic map of pop.
+	"""
+	gmap = mapOf(pop)
+	if gmap is not None:
+		if len(keep) > 0:
+			kept = sorted(set(keep))
+		else:
+			removed = set(loci)
+			kept = [x for x in range(pop.totNumLoci()) if x not in removed]
+		pop.dvars().geneticMap = array('d', [gmap[x] for x in kept])
+	pop.vars().pop('recRates', None)
+	pop.removeLoci(loci=loci, keep=keep)
+
+def recombinationRates(pop, intensity):
+	"""
+	Return loci and recombination rates between these loci and their next
+	loci on the same chromosome, calculated from the genetic map of pop. The
+	rate between two loci is their distance (in cM) times 1e6 times intensity,
+	because the genetic map uses cM/Mb as combined rate. Return None if pop
+	does not have a genetic map. The result is cached in pop.
+	"""
+	gmap = mapOf(pop)
+	if gmap is None:
+		return None
+	cache = pop.vars().setdefault('recRates', {})
+	if not cache.has_key(intensity):
+		loci = []
+		rates = []
+		scale = 1e6 * intensity
+		for ch in range(pop.numChrom()):
+			beg = pop.chromBegin(ch)
+			end = pop.chromEnd(ch)
+			chMap = gmap[beg:end]
+			loci.extend(range(beg, end - 1))
+			rates.extend([(y - x) * scale for x, y in zip(chMap[:-1], chMap[1:])])
+		cache[intensity] = (loci, rates)
+	return cache[intensity]
@@ -0,0 +1,151 @@
+"""
+A columnar on-disk format for HapMap populations, which allows the loading of
+a region of a chromosome without reading the whole population.
+
+A population with one chromosome is saved as two files:
+
+prefix.hap
+	A header line 'HAPSTORE version numLoci numHaps' followed by a bit-packed
+	haplotype matrix, one row of (numHaps + 7) / 8 bytes for each locus. Bit
+	h of a row (most significant bit first) is the allele of haplotype h,
+	namely ploidy h % 2 of individual h / 2.
+
+prefix.idx
+	Tab separated name, position, allele names (comma separated) and genetic
+	distance of each locus, in the order of loci (sorted by position),
+	after header lines '#key<tab>value' for subpopulation name, chromosome
+	name, number of individuals and HapMap release.
+
+saveStore: saves a population in this format.
+HapStore: reads the index and the haplotypes of selected loci of a saved
+	population. The haplotype matrix is memory-mapped so only rows of the
+	selected loci are read from disk.
+"""
+
+import os, mmap, bisect, binascii
+
+import geneticMap
+
+# translation tables between allele codes 0, 1 and characters '0', '1'
+_toBits = ''.join([chr(x) for x in range(256)]).replace('\x00\x01', '01', 1)
+_fromBits = ''.join([chr(x) for x in range(256)]).replace('01', '\x00\x01', 1)
+
+def storeExists(prefix):
+	"""Return True if a population has been saved to prefix in this format."""
+	return os.path.isfile(prefix + '.hap') and os.path.isfile(prefix + '.idx')
+
+def _packRow(row, rowBytes):
+	"""Pack a bytearray of allele codes to rowBytes bytes."""
+	bits = str(row.translate(_toBits)).ljust(rowBytes * 8, '0')
+	return binascii.unhexlify('%0*x' % (rowBytes * 2, int(bits, 2)))
+
+def _unpackRow(data, numHaps):
+	"""Unpack a bit-packed row to a string of numHaps allele codes."""
+	bits = bin(int(binascii.hexlify(data), 16))[2:].zfill(len(data) * 8)
+	return bits[:numHaps].translate(_fromBits)
+
+def saveStore(pop, prefix):
+	"""
+	Save a population with one chromosome to files prefix.hap and prefix.idx.
+	Files are written to temporary names and renamed when complete.
+	"""
+	numLoci = pop.totNumLoci()
+	numHaps = pop.popSize() * 2
+	rowBytes = (numHaps + 7) / 8
+	# genotypes are saved individual by individual, ploidy by ploidy, so
+	# alleles of locus l are geno[l::numLoci]
+	geno = bytearray(pop.genotype())
+	hap = open(prefix + '.hap.tmp', 'wb')
+	hap.write('HAPSTORE 1 %d %d\n' % (numLoci, numHaps))
+	for loc in xrange(numLoci):
+		hap.write(_packRow(geno[loc::numLoci], rowBytes))
+	hap.close()
+	del geno
+	gmap = geneticMap.mapOf(pop)
+	idx = open(prefix + '.idx.tmp', 'w')
+	idx.write('#subPop\t%s\n' % pop.subPopName(0))
+	idx.write('#chrom\t%s\n' % pop.chromName(0))
+	idx.write('#numInds\t%d\n' % pop.popSize())
+	if pop.vars().has_key('HapMap_rel'):
+		idx.write('#HapMap_rel\t%s\n' % pop.dvars().HapMap_rel)
+	for loc in xrange(numLoci):
+		idx.write('%s\t%d\t%s\t%s\n' % (pop.locusName(loc), int(pop.locusPos(loc)),
+			','.join(pop.alleleNames(loc)), gmap is None and 'NA' or repr(gmap[loc])))
+	idx.close()
+	os.rename(prefix + '.hap.tmp', prefix + '.hap')
+	os.rename(prefix + '.idx.tmp', prefix + '.idx')
+
+class HapStore(object):
+	"""
+	Index and haplotypes of a population saved by saveStore.
+
+	self.names, self.pos, self.alleleNames -- names, positions and allele names of loci.
+	self.geneticMap -- genetic distance of loci, or None if unavailable.
+	self.subPop, self.chrom, self.numInds -- population name, chromosome name and population size.
+	self.info -- other header fields, such as 'HapMap_rel'.
+	"""
+	def __init__(self, prefix):
+		"""Read the index of a population saved to prefix."""
+		self.prefix = prefix
+		self.names = []
+		self.pos = []
+		self.alleleNames = []
+		self.geneticMap = []
+		self.info = {}
+		for line in open(prefix + '.idx'):
+			fields = line.rstrip('\n').split('\t')
+			if line.startswith('#'):
+				self.info[fields[0][1:]] = fields[1]
+				continue
+			self.names.append(fields[0])
+			self.pos.append(int(fields[1]))
+			self.alleleNames.append(tuple(fields[2].split(',')))
+			if self.geneticMap is not None and fields[3] != 'NA':
+				self.geneticMap.append(float(fields[3]))
+			else:
+				self.geneticMap = None
+		self.subPop = self.info.pop('subPop')
+		self.chrom = self.info.pop('chrom')
+		self.numInds = int(self.info.pop('numInds'))
+		self._file = open(prefix + '.hap', 'rb')
+		header = self._file.readline().split()
+		if header[0] != 'HAPSTORE' or int(header[2]) != len(self.names):
+			raise ValueError('%s.hap does not match its index' % prefix)
+		self.numHaps = int(header[3])
+		self._offset = self._file.tell()
+		self._rowBytes = (self.numHaps + 7) / 8
+		self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def numLoci(self):
+		"""Return the number of loci."""
+		return len(self.names)
+
+	def locusRange(self, startPos=0, endPos=0):
+		"""
+		Return indexes (first, last + 1) of loci between startPos and endPos
+		(inclusive). The beginning or end of the chromosome is used if
+		startPos or endPos is zero.
+		"""
+		first = 0
+		last = len(self.pos)
+		if startPos > 0:
+			first = bisect.bisect_left(self.pos, startPos)
+		if endPos > 0:
+			last = bisect.bisect_right(self.pos, endPos)
+		return first, max(first, last)
+
+	def haplotypes(self, loci):
+		"""
+		Return alleles of given loci as a locus-major bytearray with numHaps
+		alleles for each locus. Only rows of these loci are read from disk.
+		"""
+		geno = bytearray()
+		for loc in loci:
+			start = self._offset + loc * self._rowBytes
+			geno.extend(_unpackRow(self._data[start:start + self._rowBytes], self.numHaps))
+		return geno
+
+	def close(self):
+		"""Close the haplotype file."""
+		self._data.close()
+		self._file.close()
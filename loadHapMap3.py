@@ -33,8 +33,8 @@ This script downloads and loads release 2 of hapmap phase 3 datasets in
 ftp://ftp.ncbi.nlm.nih.gov/hapmap//phasing/2009-02_phaseIII/HapMap3_r2/
 also downloads the fine-scale recombination map from
 http://ftp.hapmap.org/recombination/2008-03_rel22_B36/rates/
-and saves the genetic distance of each marker in a dictionary
-(geneticMap) in each population's local namespace.
+and saves the genetic distance of each marker in an array (geneticMap)
+in each population's local namespace.
 
 The saved populations have the following features:
 
@@ -49,7 +49,8 @@ The saved populations have the following features:
 4. Alleles are saved as 0 and 1 as appear in the HapMap datafile. Allele
   names such as 'A', 'G' are saved for each marker.
 
-5. A dictionary 'geneticMap' is used to store genetic distance of each marker.
+5. An array 'geneticMap' is used to store genetic distance of each marker, in
+  the order of loci. Use functions in geneticMap.py to access and subset it.
 
 '''
 
@@ -57,7 +58,9 @@ from simuOpt import *
 setOptions(optimized=True,quiet=True, alleleType='binary', version='1.0.1')
 from simuPOP import *
 
-import os, sys, urllib, gzip, tempfile, shutil, time
+import os, sys, gzip, tempfile, shutil, time, bisect, array
+
+import hapStore, markerList
 
 HapMap3_pops = ['ASW', 'CEU', 'CHD', 'GIH', 'JPT+CHB', 'LWK', 'MEX', 'MKK', 'TSI', 'YRI']
 HapMap3_pop_types = {
@@ -93,158 +96,295 @@ Recom_URL = 'ftp://ftp.hapmap.org/hapmap/recombination/2008-03_rel22_B36/rates/'
 genotype_file = 'hapmap3_r2_b36_fwd.consensus.qc.poly.chr%d_%s.%sphased.gz'
 recom_file = 'genetic_map_chr%s_b36.txt'
 
-def downloadIfNeeded(URL, path, file, logger=None):
-    '''Download file from hapmap website'''
-    diskfile = os.path.join(path, file)
-    # this actually will not happen because files are downloaded to
-    # a temporary directory.
-    while True:
-	   if os.path.isfile(diskfile):
-		  return diskfile	 
+def _mirrorURL(URL, mirror):
+    '''Return the location of URL under a local mirror, which should have
+    the layout of the FTP servers, e.g. mirror/ftp.hapmap.org/hapmap/...'''
+    if mirror.startswith('file://'):
+	   mirror = mirror[len('file://'):]
+    return os.path.join(mirror, URL.split('://', 1)[-1])
+
+
+def _resumeOffset(offset, size):
+    '''Return the offset from which a partially downloaded file of offset
+    bytes should be resumed if the file on the server has size bytes, or
+    None if it is already complete. The download is restarted if the
+    partial file is larger, which happens if the remote file has changed.'''
+    if size is None or offset < size:
+	   return offset
+    if offset == size:
+	   return None
+    return 0
+
+
+def _fetch(URL, partfile):
+    '''Download URL to partfile, resuming from the end of partfile if it
+    already exists and is shorter than the remote file. Return the size of
+    the file reported by the server (or of the mirrored file), or None if
+    the size is unknown.'''
+    offset = 0
+    if os.path.isfile(partfile):
+	   offset = os.path.getsize(partfile)
+    if URL.startswith('ftp://'):
+	   import ftplib
+	   host, remote = URL[len('ftp://'):].split('/', 1)
+	   ftp = ftplib.FTP(host)
+	   ftp.login()
 	   try:
-		  urllib.urlretrieve('%s/%s' % (URL, file), diskfile)
+		  ftp.voidcmd('TYPE I')
+		  try:
+			 size = ftp.size('/%s' % remote)
+		  except ftplib.error_perm:
+			 size = None
+		  offset = _resumeOffset(offset, size)
+		  if offset is not None:
+			 out = open(partfile, offset > 0 and 'ab' or 'wb')
+			 try:
+				ftp.retrbinary('RETR /%s' % remote, out.write, rest=offset or None)
+			 finally:
+				out.close()
+	   finally:
+		  ftp.close()
+	   return size
+    if '://' in URL and not URL.startswith('file://'):
+	   import urllib2
+	   if offset > 0:
+		  # a range request beyond the end of the remote file would fail
+		  request = urllib2.Request(URL)
+		  request.get_method = lambda: 'HEAD'
+		  size = urllib2.urlopen(request).info().getheader('Content-Length')
+		  if size is not None:
+			 size = int(size)
+		  offset = _resumeOffset(offset, size)
+		  if offset is None:
+			 return size
+	   request = urllib2.Request(URL)
+	   if offset > 0:
+		  request.add_header('Range', 'bytes=%d-' % offset)
+	   src = urllib2.urlopen(request)
+	   if offset > 0 and src.getcode() != 206:
+		  # server does not support partial download
+		  offset = 0
+	   size = src.info().getheader('Content-Length')
+	   if size is not None:
+		  size = offset + int(size)
+    else:
+	   src = open(URL.replace('file://', '', 1), 'rb')
+	   size = os.path.getsize(URL.replace('file://', '', 1))
+	   offset = _resumeOffset(offset, size)
+	   if offset is None:
+		  src.close()
+		  return size
+	   src.seek(offset)
+    out = open(partfile, offset > 0 and 'ab' or 'wb')
+    try:
+	   shutil.copyfileobj(src, out)
+    finally:
+	   out.close()
+	   src.close()
+    return size
+
+
+def downloadIfNeeded(URL, path, file, logger=None, mirror=None):
+    '''Download file from hapmap website, or copy it from a local mirror,
+    to a directory under path that is determined by URL. Interrupted
+    downloads are resumed. A download is kept only if its size matches the
+    size reported by the server (when the server reports one). The md5
+    checksum of a kept file is saved so that a cached file that is later
+    changed or truncated is downloaded again; this checksum is calculated
+    locally and is not compared with upstream.'''
+    import hashlib, fcntl
+    source = '%s/%s' % (URL, file)
+    cachedir = os.path.join(path, hashlib.md5(source).hexdigest())
+    if not os.path.isdir(cachedir):
+	   try:
+		  os.makedirs(cachedir)
+	   except OSError:
+		  # created by another process
+		  pass
+    diskfile = os.path.join(cachedir, file)
+    # another process might be downloading the same file
+    lock = open(diskfile + '.lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+	   if os.path.isfile(diskfile) and os.path.isfile(diskfile + '.md5'):
+		  if open(diskfile + '.md5').read().strip() == markerList.md5sum(diskfile):
+			 return diskfile
 		  if logger is not None:
-			 logger.info('%s is downloaded.' % file)
-	   except:
-		  raise SystemError('Failed to download file %s from URL %s' \
-			 % (file, URL))
-		  time.sleep(5)
+			 logger.info('Checksum of cached file %s mismatch, downloading again.' % file)
+		  os.remove(diskfile)
+	   if mirror:
+		  source = _mirrorURL(source, mirror)
+	   for attempt in range(3):
+		  try:
+			 size = _fetch(source, diskfile + '.part')
+			 if size is not None and os.path.getsize(diskfile + '.part') != size:
+				raise ValueError('%d bytes are expected' % size)
+			 break
+		  except Exception, e:
+			 # the next attempt starts afresh
+			 if os.path.isfile(diskfile + '.part'):
+				os.remove(diskfile + '.part')
+			 if attempt == 2:
+				raise SystemError('Failed to download file %s from %s: %s' \
+					% (file, source, e))
+			 time.sleep(5)
+	   os.rename(diskfile + '.part', diskfile)
+	   out = open(diskfile + '.md5', 'w')
+	   out.write(markerList.md5sum(diskfile) + '\n')
+	   out.close()
+	   if logger is not None:
+		  logger.info('%s is downloaded.' % file)
+    finally:
+	   fcntl.flock(lock, fcntl.LOCK_UN)
+	   lock.close()
     return diskfile
 
-
-def _probeInfo(datafile, logger=None):
-    '''Get population size of a sample
-	 This function also checks if each line has desired number of alleles.
-    '''
-    count = 0
-    ll = 0
-    data = gzip.open(datafile)
+def _phasedHeader(data):
+    '''Return the number of individuals and the number of columns per
+    individual from the header line of an opened phased genotype file.'''
     # rsID position name_A name_B name1_A name1_B	for others
     # rsID position name_A name_B name_0_A ...	   for TIOS
-    firstline = data.readline()
+    fields = data.readline().strip().split()[2:]
+    numCols = len(fields)
     # does not count _0_A
-    numInds = len([x for x in firstline.strip().split()[2:] if x.endswith('_B')])
+    numInds = len([x for x in fields if x.endswith('_B')])
+    indCols = numCols / numInds
+    if indCols * numInds != numCols:
+	   raise SystemError('Something wrong with individual count.')
+    return numInds, indCols
+
+
+def _readPhased(datafile, logger=None):
+    '''Read a phased genotype file in a single pass. This function returns
+    the number of individuals, number of columns per individual, names,
+    positions and allele names of loci, and a locus by column matrix of
+    undecoded alleles. The file is streamed line by line so that only the
+    allele matrix is kept in memory.
+    '''
+    data = gzip.open(datafile)
+    numInds, indCols = _phasedHeader(data)
+    numCols = numInds * indCols
     name = []
     alleleNames = {}
     pos = []
-    for line in data.readlines():
-	   data = line.split()
-	   name.append(data[0])
-	   pos.append(int(data[1]))
-	   alleles = list(set(data[2:]))
-	   alleles.sort()
-	   alleleNames[data[0]] = alleles
-    return numInds, name, alleleNames, pos
-    
+    geno = bytearray()
+    for line in data:
+	   fields = line.split()
+	   alleles = ''.join(fields[2:])
+	   if len(alleles) != numCols:
+		  raise ValueError('Unexpected genotype of locus %s' % fields[0])
+	   name.append(fields[0])
+	   pos.append(int(fields[1]))
+	   alleleNames[fields[0]] = sorted(set(alleles))
+	   geno.extend(alleles)
+    data.close()
+    return numInds, indCols, name, alleleNames, pos, geno
 
-def load_population(pop, diskFiles, alleleNames, logger=None):
-    '''Load population from file, with type (subpopulation type)'''
-    # file format:
-    #
-    # rsID pos ind1_A ind2_A ....
-    #
-    ind_base = 0
-    for diskfile in diskFiles:
-	   data = gzip.open(diskfile)
-	   fields = data.readline().split()[2:]
-	   numInd = len([x for x in fields if x.endswith('_B')])
-	   indCols = len(fields) / numInd
-	   if indCols * numInd != len(fields):
-		  raise SystemError('Something wrong with individual count.')
+
+def _alleleTable(alleleName, cache={}):
+    '''Return a translation table that maps allele names to allele codes
+    0, 1, ... so that a whole line of genotypes can be decoded at once.'''
+    key = tuple(alleleName)
+    if not cache.has_key(key):
+	   table = [chr(x) for x in range(256)]
+	   for code,allele in enumerate(alleleName):
+		  table[ord(allele)] = chr(code)
+	   cache[key] = ''.join(table)
+    return cache[key]
+
+
+def _setGenotypes(pop, geno, numCols, indCols, numInd, ind_base=0):
+    '''Copy a locus-major allele matrix to individuals ind_base, ...,
+    ind_base + numInd - 1 of pop, one call per individual and ploidy.'''
+    if ind_base + numInd > pop.popSize():
+	   print 'Warning: individual index %d greater than population size %d ' % (ind_base + numInd, pop.popSize())
+	   numInd = pop.popSize() - ind_base
+    for idx in range(numInd):
+	   ind = pop.individual(ind_base + idx)
+	   for ploidy in range(2):
+		  # column idx * indCols + ploidy of all loci
+		  ind.setGenotype(list(geno[idx * indCols + ploidy::numCols]), ploidy)
+
+
+def load_population(pop, samples, alleleNames, logger=None, ind_base=0):
+    '''Load population from samples returned by _readPhased, with type
+    (subpopulation type), starting from individual ind_base'''
+    # Allele matrices are decoded in place, one locus at a time, and then
+    # copied to individuals in bulk.
+    lociNames = pop.lociNames()
+    for numInd, indCols, geno in samples:
+	   numCols = numInd * indCols
+	   if len(geno) != pop.totNumLoci() * numCols:
+		  raise ValueError('Genotypes of %d loci are expected' % pop.totNumLoci())
 	   if logger:
-		  logger.info("Importing genotypes of %d individuals from %s..." % (numInd, os.path.split(diskfile)[-1]))
-	   for line_no,line in enumerate(data.readlines()):
-		  fields = line.split()
-		  name = fields[0]
-		  alleleName = alleleNames[name]
-		  genotype = [alleleName.index(x) for x in fields[2:]]
-		  for col_no,geno in enumerate(genotype):
-			 ind = ind_base + col_no / indCols
-			 ploidy = col_no % indCols
-			 if ploidy == 2:
-				continue
-			 if ind == pop.popSize():
-				print 'Warning: individual index %d greater than population size %d ' % (ind, pop.popSize())
-			 # always chromosome 0, because each population has only one chromosome
-			 assert pop.locusPos(line_no) == float(fields[1])
-			 assert pop.locusName(line_no) == name
-			 pop.individual(ind).setAllele(geno, line_no, ploidy)
+		  logger.info("Importing genotypes of %d individuals..." % numInd)
+	   for loc,name in enumerate(lociNames):
+		  # always chromosome 0, because each population has only one chromosome
+		  start = loc * numCols
+		  geno[start:start + numCols] = geno[start:start + numCols].translate(_alleleTable(alleleNames[name]))
+	   # any byte left after removing codes 0 and 1 is an unknown allele
+	   if len(geno.translate(None, '\x00\x01')) != 0:
+		  raise ValueError('Unrecognized allele names')
+	   _setGenotypes(pop, geno, numCols, indCols, numInd, ind_base)
 	   ind_base += numInd
 
 
-def set_map_dist(pop, ch, dest, logger=None):
+def set_map_dist(pop, ch, dest, logger=None, mirror=None):
     '''Set map distance for each locus'''
     file = recom_file % ch
-    downloadIfNeeded(Recom_URL, dest, file, logger)
+    diskfile = downloadIfNeeded(Recom_URL, dest, file, logger, mirror)
     if logger is not None:
 	   logger.info('Using genetic map file %s' % file)
-    dist = {}
-    for line in open(os.path.join(dest, file)).readlines():
+    entries = []
+    for line in open(diskfile):
 	   try:
 		  fields = line.split()
-		  pos = int(fields[0])
-		  dist[pos] = float(fields[2])
+		  entries.append((int(fields[0]), float(fields[2])))
 	   except:
 		  pass
+    # sorted positions and distances of the map. The sort is stable so the
+    # last entry is used for duplicated positions.
+    entries.sort(key=lambda x: x[0])
+    mapPos = [x[0] for x in entries]
+    mapDist = [x[1] for x in entries]
+    del entries
     if logger is not None:
-	   logger.info('Map distance of %d markers are found' % len(dist))
-    totNumLoci = pop.totNumLoci()
-    # now, try to set genetic map
-    map_dist = [-1]*totNumLoci;
-    cnt = 0
-    for loc in range(totNumLoci):
-	   pos = int(int(pop.locusPos(loc)))
-	   try:
-		  map_dist[loc] = dist[pos]
-		  cnt += 1
-	   except:
-		  pass
+	   logger.info('Map distance of %d markers are found' % len(set(mapPos)))
+    lociPos = pop.lociPos()
+    totNumLoci = len(lociPos)
+    # now, try to set genetic map, locating each marker in the map
+    map_dist = [None] * totNumLoci
+    idx = [bisect.bisect_right(mapPos, int(x)) - 1 for x in lociPos]
+    known = [loc for loc in range(totNumLoci) if idx[loc] >= 0 and mapPos[idx[loc]] == int(lociPos[loc])]
+    for loc in known:
+	   map_dist[loc] = mapDist[idx[loc]]
+    cnt = len(known)
+    if cnt == 0:
+	   raise ValueError('None of the markers is found in genetic map file %s' % file)
     if cnt != totNumLoci:
-	   prev = -1	# name of the previous marker with map distance
-	   next = -1	# name of the next marker with map distance
-	   loc = 0
-	   while (loc < totNumLoci):
-		  # already has value
-		  if map_dist[loc] != -1:
-			 prev = next = loc
-			 loc += 1
-			 continue
-		  # find the ext one
-		  if prev == next:
-			 next = -1
-			 for n in range(loc+1, totNumLoci):
-				 if map_dist[n] != -1:
-					next = n
-					next_pos = pop.locusPos(next)
-					next_dis = map_dist[next]
-					break
-			 if prev == -1:
-				for n in range(next):
-				    # rough estimation: distance (in cM) proportional to 0.01 recombination rate
-				    map_dist[n] = map_dist[next] - (pop.locusPos(next) - pop.locusPos(n)) * 1e-8
-			 # if not found, this is at the end of a chromosome
-			 elif next == -1:
-				for n in range(loc, totNumLoci):
-				    map_dist[n] = map_dist[prev] + (pop.locusPos(n) - pop.locusPos(prev)) * 1e-8
-				break
-			 # if found, but no previous, this is the first one
-			 else:
-				prev_pos = pop.locusPos(prev)
-				prev_dis = map_dist[prev]
-				for n in range(loc, next):
-				    map_dist[n] = map_dist[prev] + (pop.locusPos(n) - prev_pos) / (next_pos - prev_pos) * (next_dis - prev_dis)
-			 prev = next
-			 loc = next + 1
+	   # markers with map distances before and after each missing marker
+	   for loc in [x for x in range(totNumLoci) if map_dist[x] is None]:
+		  k = bisect.bisect_left(known, loc)
+		  if k == 0:
+			 # rough estimation: distance (in cM) proportional to 0.01 recombination rate
+			 next = known[0]
+			 map_dist[loc] = map_dist[next] - (lociPos[next] - lociPos[loc]) * 1e-8
+		  elif k == cnt:
+			 # this is at the end of a chromosome
+			 prev = known[-1]
+			 map_dist[loc] = map_dist[prev] + (lociPos[loc] - lociPos[prev]) * 1e-8
+		  else:
+			 prev = known[k - 1]
+			 next = known[k]
+			 map_dist[loc] = map_dist[prev] + (lociPos[loc] - lociPos[prev]) / (lociPos[next] - lociPos[prev]) * \
+				(map_dist[next] - map_dist[prev])
     if totNumLoci != cnt and logger is not None:
 	   logger.info('Map distance of %d markers (%.2f%% of %d) are estimated' % (totNumLoci - cnt,
 		  (totNumLoci - cnt) * 100.0/totNumLoci, totNumLoci))
-    map = {}
-    for loc in range(totNumLoci):
-	   map[pop.locusName(loc)] = map_dist[loc]
-    pop.dvars().geneticMap = map
+    pop.dvars().geneticMap = array.array('d', map_dist)
 
-    
-def loadHapMapPop(chrom, popName, logger=None):
+
+def loadHapMapPop(chrom, popName, logger=None, cache=None, mirror=None):
     '''Download and import the specified chromosome of a hapmap population.
     If a directory is specified, the loaded population will be saved in
     simuPOP format with filename HapMap_XXX_chrY.pop where XXX is population
@@ -261,66 +401,176 @@ def loadHapMapPop(chrom, popName, logger=None):
 	   An optional logger object (c.f. the Python logging module) where all
 	   logging and debugging information is written to.
 
+    cache
+	   A directory to keep downloaded files so that they are not downloaded
+	   again. Files are downloaded to a temporary directory and removed
+	   afterwards if this parameter is not specified.
+
+    mirror
+	   A local directory (or file:// URL) with the layout of the HapMap FTP
+	   servers (e.g. mirror/ftp.hapmap.org/hapmap/...) that is used instead
+	   of the FTP servers.
+
     This function returns the loaded population.
     '''
 
     if logger is not None:
 	   logger.info("Loading HapMap3 chromosome %d of population %s" % (chrom, popName))
-    tmpdir = tempfile.mkdtemp()
+    if cache:
+	   tmpdir = cache
+    else:
+	   tmpdir = tempfile.mkdtemp()
     URL = Genotype_URL % (popName.upper())
     sampleCode = {'': 'unr.', 'DUOS':'D.', 'TRIOS':'', 'UNRELATED':'unr.'}
     totNumInds = 0
-    allAlleleNames = {}
-    allLociPos = []
-    allLociNames = []
-    diskFiles = []
+    diskfiles = []
+    # the number of individuals is read from the header of each file, so that
+    # the population can be created before any genotype is read
     for sampleType in HapMap3_pop_types[popName]:
 	   datafile = genotype_file % (chrom, popName.lower(), sampleCode[sampleType])
 	   if sampleType == '':
-		  diskfile = downloadIfNeeded(URL, tmpdir, datafile, logger)
+		  diskfile = downloadIfNeeded(URL, tmpdir, datafile, logger, mirror)
 	   else:
-		  diskfile = downloadIfNeeded(URL + '/' + sampleType, tmpdir, datafile, logger)
-	   (numInds, lociNames, alleleNames, lociPos) = _probeInfo(diskfile)
-	   diskFiles.append(diskfile)
+		  diskfile = downloadIfNeeded(URL + '/' + sampleType, tmpdir, datafile, logger, mirror)
+	   data = gzip.open(diskfile)
+	   numInds, indCols = _phasedHeader(data)
+	   data.close()
+	   diskfiles.append(diskfile)
+	   totNumInds += numInds
+	   if sampleType == '':
+		  break
+    #
+    # each file is read once and decoded into the population before the next
+    # file is read. Loaded genotypes are recoded at loci that are monomorphic
+    # in earlier files and have another allele in a later file.
+    pop = None
+    ind_base = 0
+    for diskfile in diskfiles:
+	   (numInds, indCols, lociNames, alleleNames, lociPos, geno) = _readPhased(diskfile, logger)
 	   if logger:
 		  logger.info('Genotypes of %d individuals at %d loci are found' % (numInds, len(lociNames)))
-	   totNumInds += numInds
-	   if not allLociPos:
+	   if pop is None:
+		  if logger is not None:
+			 logger.info("Genotypes %d individuals of %d loci (%d - %d bp) are located" % (totNumInds,
+				len(lociNames), lociPos[0], lociPos[-1]))
 		  allLociPos = lociPos
+		  allLociNames = lociNames
+		  allAlleleNames = alleleNames
+		  pop = Population(size=totNumInds, ploidy=2, loci=[len(lociPos)],
+			 lociPos=allLociPos, lociNames=allLociNames, chromNames=[str(chrom)],
+			 alleleNames=[allAlleleNames[x] for x in allLociNames], subPopNames=[popName])
 	   else:
 		  if allLociPos != lociPos:
 			 raise ValueError("Loci position mismatch.")
-	   if not allLociNames:
-		  allLociNames = lociNames
-	   else:
 		  if allLociNames != lociNames:
 			 raise ValueError("Loci name mismatch.")
-	   for key in alleleNames:
-		  if allAlleleNames.has_key(key):
-			 if len(allAlleleNames[key]) == 1:
+		  # loci whose allele 0 becomes allele 0 or 1, and their new allele names
+		  recode_loci = {0:[], 1:[]}
+		  recode_names = {0:[], 1:[]}
+		  for loc, key in enumerate(lociNames):
+			 if len(allAlleleNames[key]) == 1 and alleleNames[key] != allAlleleNames[key]:
 				if len(alleleNames[key]) == 2:
-				    allAlleleNames[key] = alleleNames[key]
-				elif alleleNames[key][0] != allAlleleNames[key][0]:
-				    alleles = [alleleNames[key][0], allAlleleNames[key][1]]
+				    alleles = alleleNames[key]
+				else:
+				    alleles = [alleleNames[key][0], allAlleleNames[key][0]]
 				    alleles.sort()
-				    allAlleleNames[key] = alleles
-		  else:
-			 allAlleleNames[key] = alleleNames[key]
-	   if sampleType == '':
-		  break
-    #
-    if logger is not None:
-	   logger.info("Genotypes %d individuals of %d loci (%d - %d bp) are located" % (totNumInds, 
-		  len(allLociNames), allLociPos[0], allLociPos[-1]))
-    pop = Population(size=totNumInds, ploidy=2, loci=[len(lociPos)],
-	   lociPos=allLociPos, lociNames=allLociNames, chromNames=[str(chrom)],
-	   alleleNames=[allAlleleNames[x] for x in allLociNames], subPopNames=[popName])
-    load_population(pop, diskFiles, allAlleleNames, logger)
-    set_map_dist(pop, chrom, tmpdir, logger)
+				toAllele = alleles.index(allAlleleNames[key][0])
+				recode_loci[toAllele].append(loc)
+				recode_names[toAllele].append(alleles)
+				allAlleleNames[key] = alleles
+		  if len(recode_loci[0]) > 0:
+			 pop.recodeAlleles(alleles=[0, 1], loci=recode_loci[0], alleleNames=recode_names[0])
+		  if len(recode_loci[1]) > 0:
+			 pop.recodeAlleles(alleles=[1, 0], loci=recode_loci[1], alleleNames=recode_names[1])
+	   load_population(pop, [(numInds, indCols, geno)], allAlleleNames, logger, ind_base)
+	   del geno
+	   ind_base += numInds
+    set_map_dist(pop, chrom, tmpdir, logger, mirror)
     pop.dvars().HapMap_rel = release
-    shutil.rmtree(tmpdir)
+    if not cache:
+	   shutil.rmtree(tmpdir)
     return pop
 
+def _buildHapMapPop(args):
+    '''Import and save one population for one chromosome, skipping existing
+    valid files. This function is used by loadHapMapPops as a task in a
+    process pool and returns (status, popFile) where status is one of
+    'built', 'skipped' and 'failed'.'''
+    chrom, sample, dest, cache, mirror, columnar = args
+    import logging
+    logger = logging.getLogger('loadHapMap3.%s_chr%d' % (sample, chrom))
+    popFile = os.path.join(dest, "HapMap3_%s_chr%d.pop" % (sample, chrom))
+    try:
+	   if os.path.isfile(popFile):
+		  # test if this file is OK.
+		  pop = loadPopulation(popFile)
+		  if pop.popSize() == HapMap3_pop_sizes[sample]:
+			 logger.info("Skipping existing population %s." % popFile)
+			 if columnar and not hapStore.storeExists(popFile[:-4]):
+				logger.info("Save population to %s.hap and %s.idx" % (popFile[:-4], popFile[:-4]))
+				hapStore.saveStore(pop, popFile[:-4])
+			 return ('skipped', popFile)
+    except:
+	   # continue to load file
+	   pass
+    try:
+	   pop = loadHapMapPop(chrom, sample, logger, cache, mirror)
+	   logger.info("Save population to %s." % popFile)
+	   pop.save(popFile)
+	   if columnar:
+		  logger.info("Save population to %s.hap and %s.idx" % (popFile[:-4], popFile[:-4]))
+		  hapStore.saveStore(pop, popFile[:-4])
+    except Exception, e:
+	   logger.error("Failed to create population %s: %s" % (popFile, e))
+	   return ('failed', popFile)
+    return ('built', popFile)
+
+
+def loadHapMapPops(chroms, pops, dest, jobs=1, logger=None, cache=None, mirror=None,
+	   columnar=True):
+    '''Download, import and save the specified chromosomes of the specified
+    populations to directory dest, as files HapMap3_XXX_chrY.pop. Existing
+    files are not overwritten. If columnar is True, populations are also
+    saved in a columnar format (HapMap3_XXX_chrY.hap and .idx, see hapStore.py)
+    that allows the loading of regions of chromosomes.
+
+    chroms
+	   chromosomes to download (1, 2, ..., 22).
+
+    pops
+	   Names of the populations, should be in HapMap3_pops.
+
+    jobs
+	   Number of processes. Each chromosome of each population is imported
+	   by a separate task so that up to jobs tasks can run in parallel.
+
+    cache, mirror
+	   Download cache and local mirror of the HapMap FTP servers, passed
+	   to loadHapMapPop.
+
+    This function returns a dictionary with keys 'built', 'skipped' and
+    'failed', each with a list of population files.
+    '''
+    tasks = [(chrom, sample, dest, cache, mirror, columnar) for chrom in chroms for sample in pops]
+    if jobs > 1 and len(tasks) > 1:
+	   import multiprocessing
+	   if logger is not None:
+		  logger.info("Importing %d populations using %d processes" % (len(tasks), jobs))
+	   pool = multiprocessing.Pool(min(jobs, len(tasks)))
+	   results = pool.map(_buildHapMapPop, tasks, chunksize=1)
+	   pool.close()
+	   pool.join()
+    else:
+	   results = [_buildHapMapPop(task) for task in tasks]
+    summary = {'built': [], 'skipped': [], 'failed': []}
+    for status, popFile in results:
+	   summary[status].append(popFile)
+    if logger is not None:
+	   logger.info("%d populations are built, %d skipped, and %d failed." % \
+		  (len(summary['built']), len(summary['skipped']), len(summary['failed'])))
+    return summary
+
+
 options = [
     {'longarg': 'dest=',
 	'default': 'HapMap',
@@ -349,7 +599,44 @@ options = [
 	'default':True,
 	'type':bool,
 	'label':"Skip Downloading and File Checking?"
-	}
+	},
+    {'longarg': 'jobs=',
+	'default': 1,
+	'useDefault': True,
+	'label': 'Number of parallel jobs',
+	'allowedTypes': [type(0)],
+	'validate': valueGE(1),
+	'description': '''Number of processes used to download and import
+	   populations. Each chromosome of each population is processed by
+	   a separate task.''',
+    },
+    {'longarg': 'cache=',
+	'default': '',
+	'useDefault': True,
+	'label': 'Download cache directory',
+	'allowedTypes': [type('')],
+	'description': '''A directory to keep downloaded files, which are verified
+	   by their checksums and are not downloaded again. Directory "cache"
+	   under the destination directory is used if unspecified.''',
+    },
+    {'longarg': 'mirror=',
+	'default': '',
+	'useDefault': True,
+	'label': 'Local mirror of HapMap FTP sites',
+	'allowedTypes': [type('')],
+	'description': '''A local directory or file:// URL with the layout of the
+	   HapMap FTP servers (e.g. mirror/ftp.hapmap.org/hapmap/...) to be used
+	   instead of the FTP servers, for example on nodes without internet access.''',
+    },
+    {'longarg': 'columnar',
+	'default': True,
+	'useDefault': True,
+	'label': 'Also save in columnar format',
+	'allowedTypes': [type(True)],
+	'description': '''Also save populations in a columnar format (files with
+	   extensions .hap and .idx) from which selectMarkers.py can load
+	   regions of chromosomes without loading whole populations.''',
+    },
 ]
 
 
@@ -359,26 +646,14 @@ if __name__ == '__main__':
 	   'This script downloads the second release of the phase 3 of the HapMap datasets\n'
 	   'and saves them in simuPOP format. It also downloads the fine-scale\n'
 	   'recombination map and saves the genetic distance of each marker in\n'
-	   'a dictionary (geneticMap) in the population\'s local namespace.',
+	   'an array (geneticMap) in the population\'s local namespace.',
 	   __doc__)
     if not pars.getParam():
 	   sys.exit(1)
     import logging
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger('loadHapMap3')
-    for chrom in pars.chroms:
-	   for sample in HapMap3_pops:
-		  popFile = os.path.join(pars.dest, "HapMap3_%s_chr%d.pop" % (sample, chrom))
-		  try:
-			 if os.path.isfile(popFile):
-				# test if this file is OK.
-				pop = loadPopulation(popFile)
-				if pop.popSize() == HapMap3_pop_sizes[sample]:
-				    logger.info("Skipping existing population %s." % popFile)
-				    continue
-		  except:
-			 # continue to load file
-			 pass
-		  pop = loadHapMapPop(chrom, sample, logger)
-		  logger.info("Save population to %s." % popFile)
-		  pop.save(popFile)
+    summary = loadHapMapPops(pars.chroms, HapMap3_pops, pars.dest, pars.jobs, logger,
+	   pars.cache or os.path.join(pars.dest, 'cache'), pars.mirror, pars.columnar)
+    if len(summary['failed']) > 0:
+	   sys.exit(1)
@@ -0,0 +1,204 @@
+"""
+Compiled marker lists, such as the Illumina HumanHap550 SNP table
+(hh550v3_snptable.txt), used to select markers from HapMap populations.
+
+A marker list file has one marker per line. The first comma or whitespace
+separated field of a line is the name of the marker, and the second field,
+if present and a chromosome name (1-22, X, Y, XY or MT, optionally with
+prefix chr), is its chromosome. Empty lines and lines starting with '#'
+are ignored.
+
+Parsing a list of half a million markers is slow, so a list file is
+compiled to filename.mlx when it is first used. The header of the index
+records the modification time, size and md5 checksum of the list file,
+and the index is rebuilt when the list file changes. For each chromosome
+(0 for markers without a chromosome), the index holds a sorted array of
+the numbers of rs markers (4-byte little-endian integers) followed by
+the sorted names of other markers.
+
+MarkerList: markers of a list file, optionally of some chromosomes only,
+	supporting 'name in markers' and len(markers) without creating a
+	string for each marker.
+"""
+
+import os, sys, array, bisect, cStringIO
+
+_version = 1
+
+# chromosome codes used in the index
+_chromCodes = dict([(str(x), x) for x in range(1, 23)] +
+	[('X', 23), ('Y', 24), ('XY', 25), ('MT', 26), ('M', 26)])
+
+def parseLine(line):
+	"""
+	Return the name and chromosome code (0 if unknown) of the marker at a
+	line of a marker list file, or None if the line is empty or a comment.
+	"""
+	if line.startswith('#') or line.strip() == '':
+		return None
+	fields = line.replace(',', ' ').split()
+	chrom = 0
+	if len(fields) > 1:
+		ch = fields[1].upper()
+		if ch.startswith('CHR'):
+			ch = ch[3:]
+		chrom = _chromCodes.get(ch, 0)
+	return fields[0], chrom
+
+def _rsNumber(name):
+	"""Return the number of a rs marker, or None for other markers."""
+	if name.startswith('rs') and name[2:].isdigit():
+		return int(name[2:])
+	return None
+
+def md5sum(filename):
+	"""Return the md5 checksum of a file"""
+	import hashlib
+	md5 = hashlib.md5()
+	f = open(filename, 'rb')
+	for block in iter(lambda: f.read(1048576), ''):
+		md5.update(block)
+	f.close()
+	return md5.hexdigest()
+
+def _key(filename, md5=None):
+	"""Return the header line that identifies the current content of a list file."""
+	st = os.stat(filename)
+	if md5 is None:
+		md5 = md5sum(filename)
+	return '%20.6f %20d %s\n' % (st.st_mtime, st.st_size, md5)
+
+def _compile(filename):
+	"""Parse a marker list file and return the content of its index."""
+	rs = {}
+	other = {}
+	for line in open(filename, 'rU'):
+		marker = parseLine(line)
+		if marker is None:
+			continue
+		name, chrom = marker
+		num = _rsNumber(name)
+		if num is None:
+			other.setdefault(chrom, set()).add(name)
+		else:
+			rs.setdefault(chrom, set()).add(num)
+	data = ['MARKERLIST %d\n' % _version, _key(filename)]
+	for chrom in sorted(set(rs.keys() + other.keys())):
+		ids = array.array('I', sorted(rs.get(chrom, [])))
+		if sys.byteorder == 'big':
+			ids.byteswap()
+		names = '\n'.join(sorted(other.get(chrom, [])))
+		data.append('%d %d %d\n' % (chrom, len(ids), len(names)))
+		data.append(ids.tostring())
+		data.append(names)
+	return ''.join(data)
+
+def _isCurrent(filename, index):
+	"""
+	Return True if index was compiled from the current content of filename.
+	If only the modification time of filename has changed, the header of
+	index is updated so that the checksum is not calculated again.
+	"""
+	try:
+		f = open(index, 'rb')
+		header = f.readline()
+		key = f.readline()
+		f.close()
+	except IOError:
+		return False
+	fields = key.split()
+	if header != 'MARKERLIST %d\n' % _version or len(fields) != 3:
+		return False
+	st = os.stat(filename)
+	if fields[0] == '%.6f' % st.st_mtime and int(fields[1]) == st.st_size:
+		return True
+	if int(fields[1]) != st.st_size or md5sum(filename) != fields[2]:
+		return False
+	try:
+		f = open(index, 'r+b')
+		f.seek(len(header))
+		f.write(_key(filename, fields[2]))
+		f.close()
+	except IOError:
+		pass
+	return True
+
+class MarkerList(object):
+	"""
+	Markers in a marker list file.
+
+	self.filename -- name of the marker list file.
+	self.chroms -- chromosomes of loaded markers, empty for all markers.
+		Markers without a chromosome are always loaded.
+	"""
+	def __init__(self, filename, chroms=[], logger=None):
+		"""
+		Load markers on chromosomes chroms (all markers if chroms is empty)
+		from the index of filename, which is compiled if it does not exist
+		or is out of date.
+		"""
+		self.filename = filename
+		self.chroms = list(chroms)
+		self._ids = []
+		self._names = set()
+		index = filename + '.mlx'
+		if _isCurrent(filename, index):
+			f = open(index, 'rb')
+		else:
+			if logger:
+				logger.info('Compiling marker list %s to %s' % (filename, index))
+			data = _compile(filename)
+			try:
+				out = open(index + '.tmp', 'wb')
+				out.write(data)
+				out.close()
+				os.rename(index + '.tmp', index)
+			except (IOError, OSError), e:
+				if logger:
+					logger.warning('Failed to save compiled marker list %s: %s' % (index, e))
+			f = cStringIO.StringIO(data)
+		codes = set([_chromCodes.get(str(x).upper(), 0) for x in chroms])
+		f.readline()
+		f.readline()
+		while True:
+			line = f.readline()
+			if not line:
+				break
+			chrom, numIds, size = [int(x) for x in line.split()]
+			if len(codes) > 0 and chrom != 0 and chrom not in codes:
+				f.seek(numIds * 4 + size, 1)
+				continue
+			ids = array.array('I')
+			ids.fromstring(f.read(numIds * 4))
+			if sys.byteorder == 'big':
+				ids.byteswap()
+			if numIds > 0:
+				self._ids.append(ids)
+			if size > 0:
+				self._names.update(f.read(size).split('\n'))
+		f.close()
+		if logger:
+			logger.info('%d markers located from marker list file %s' % (len(self), filename))
+
+	def __contains__(self, name):
+		"""Return True if marker name is in the list."""
+		num = _rsNumber(name)
+		if num is None:
+			return name in self._names
+		for ids in self._ids:
+			idx = bisect.bisect_left(ids, num)
+			if idx < len(ids) and ids[idx] == num:
+				return True
+		return False
+
+	def __len__(self):
+		"""Return the number of markers."""
+		return sum([len(x) for x in self._ids]) + len(self._names)
+
+	def __iter__(self):
+		"""Iterate through names of markers."""
+		for ids in self._ids:
+			for num in ids:
+				yield 'rs%d' % num
+		for name in sorted(self._names):
+			yield name
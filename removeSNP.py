@@ -14,6 +14,7 @@ removeDPL: removes the DPL
 import simuOpt
 simuOpt.setOptions(alleleType='binary', optimized=True,quiet=True)
 import simuPOP as sim
+import geneticMap
 
 def removeRare(pop,thresh_hi=0.999999,thresh_lo=0.000001,DPL=['rs4491689'],savefile=False):
 	"""
@@ -27,7 +28,7 @@ def removeRare(pop,thresh_hi=0.999999,thresh_lo=0.000001,DPL=['rs4491689'],savef
 	"""
 	sim.stat(pop,alleleFreq=range(pop.totNumLoci()))
 	lociToRemove = [l for l in xrange(pop.totNumLoci()) if pop.dvars().alleleFreq[l][0] > thresh_hi or pop.dvars().alleleFreq[l][0] < thresh_lo]
-	pop.removeLoci(lociToRemove)
+	geneticMap.removeLoci(pop, lociToRemove)
 	if savefile:
 		pop.save(savefile)
 	return len(lociToRemove),[pop.locusByName(x) for x in DPL]
@@ -48,7 +49,7 @@ def removeDPL(pop,DPL=['rs4491689'],savefile=False):
 	"""
 	for locus in DPL:
 		try:
-			pop.removeLoci(pop.locusByName(locus))
+			geneticMap.removeLoci(pop, [pop.locusByName(locus)])
 		except ValueError:
 			return "Locus %s already removed!" %locus
 	if savefile:
@@ -50,11 +50,11 @@ Replicatior options include:
 	genotype relative risk (for the heterozygote)
 
 """
-import os, errno,sys
+import os, errno,sys,random,itertools
 import simuOpt
 import DPLSim
 from DPLSim.analysisMethods import my_import
-from DPLSim import singleGeneModel
+from DPLSim import singleGeneModel, simuGWAS
 
 
 def mkdir_p(path):
@@ -190,7 +190,39 @@ replicator_options = [
 	'default':True,
 	'type':bool,
 	'label':"Create Directories Here and Now?"
-	}
+	},
+		{'separator':"Parallel runs"},
+		{'name':'workers',
+		'default':1,
+		'label':'Number of worker processes',
+		'description':"""Number of processes used to expand populations and to sample
+		case/control datasets of the grid.""",
+		'type':int,
+		'validate':simuOpt.valueGE(1)
+		},
+		{'name':'seed',
+		'default':0,
+		'label':'Master random seed (0 for random)',
+		'type':int,
+		'validate':simuOpt.valueGE(0)
+		},
+		{'name':'offspringPool',
+		'default':'none',
+		'label':'Offspring pool for case/control sampling',
+		'type':('chooseOneOf',['none','replicate']),
+		'description':"""none: every dataset is sampled from its own offspring.
+		replicate: datasets with the same CC, WTR and GRR replicate numbers are sampled from
+		one pool of offspring and their random numbers (common random numbers across levels),
+		so that replicates remain independent."""
+		},
+		{'name':'nestedCC',
+		'default':False,
+		'type':bool,
+		'label':'Nested CC levels',
+		'description':"""If set, the design with the largest number of controls is sampled once
+		and smaller CC levels are nested random subsets of its controls. Indexes of individuals of
+		the largest dataset in each dataset are saved as sample.members."""
+		}
 	]
 
 short_desc = """
@@ -268,6 +300,130 @@ def dir_setup(rep_opt,logger=None):
 	logger.info("Created %d new directories" % num_created)									
 	return dirpaths
 
+def cell_seed(seed,*coords):
+	"""
+	Return a random seed for one cell of the replication grid, derived from the
+	master seed and the coordinates of the cell (level indexes and replicate
+	numbers), so that cells are independent and reproducible.
+	"""
+	import hashlib
+	return int(hashlib.md5(repr((seed,) + coords)).hexdigest()[:8],16) % 4294967295 + 1
+
+def master_seed(rep_opt,logger=None):
+	"""Return the master seed of rep_opt, choosing and logging one if it is zero."""
+	seed = rep_opt.seed
+	if seed == 0:
+		import random
+		seed = random.SystemRandom().randint(1,2**31)
+	if logger:
+		logger.info("Master random seed is %d" % seed)
+	return seed
+
+_initPop = {}
+
+def _load_init(filename):
+	"""Load the initial population once in a worker process."""
+	from simuPOP import loadPopulation
+	_initPop['pop'] = loadPopulation(filename)
+
+def _task_files(gwas_opts,prefix):
+	"""
+	Return the trajectory and recombination files of a task, named after prefix if they
+	are requested in gwas_opts, so that tasks do not write to the same files.
+	"""
+	return dict([(name,gwas_opts.get(name) and prefix + ext or '')
+		for name,ext in [('trajFile','.traj'),('dumpRec','.rec')]])
+
+def _expand_task(args):
+	"""
+	Expand the initial population of the worker for one MAF level and replicate.
+	args are the simuGWAS options (a dictionary), the MAF, the seed and the filename
+	of the expanded population. Return the filename.
+	"""
+	import logging
+	gwas_opts,maf,seed,filename = args
+	logger = logging.getLogger('replicator.%s' % os.path.basename(filename)[:-4])
+	pars = simuOpt.Params(simuGWAS.options,**dict(gwas_opts,**_task_files(gwas_opts,filename[:-4])))
+	pars.curAlleleFreq = [maf]
+	pars.seed = seed
+	pars.filename = filename
+	pars.checkpointDir = filename + '.ckpt'
+	pop = simuGWAS.simuGWAS(pars,_initPop['pop'].clone(),logger)
+	pop.vars().clear()
+	pop.save(filename + '.tmp')
+	os.rename(filename + '.tmp',filename)
+	logger.info("Expanded population saved at %s" % filename)
+	return filename
+
+def _branch_task(args):
+	"""
+	Evolve a shared burn-in from the initial population of the worker and branch it to
+	all MAF levels of one replicate. args are the simuGWAS options (a dictionary), the
+	seed of the burn-in, the checkpoint directory of the burn-in and a list of (MAF, seed,
+	filename) of the branches. Return the filenames of the expanded populations.
+	"""
+	import logging
+	gwas_opts,seed,ckpt_dir,branches = args
+	logger = logging.getLogger('replicator.%s' % os.path.basename(ckpt_dir))
+	pars = simuOpt.Params(simuGWAS.options,**dict(gwas_opts,**_task_files(gwas_opts,ckpt_dir[:-5])))
+	pars.seed = seed
+	pars.checkpointDir = ckpt_dir
+	scenarios = [dict(_task_files(gwas_opts,filename[:-4]),curAlleleFreq=[maf],seed=maf_seed,filename=filename + '.tmp')
+		for maf,maf_seed,filename in branches]
+	filenames = simuGWAS.simuGWASBranches(pars,_initPop['pop'].clone(),scenarios,logger)
+	for filename in filenames:
+		os.rename(filename,filename[:-4])
+		logger.info("Expanded population saved at %s" % filename[:-4])
+	return [x[:-4] for x in filenames]
+
+def rep_expand(rep_opt,gwas_pars,logger=None):
+	"""
+	Expand the initial population gwas_pars.initPop for every MAF level and replicate,
+	saving them as MAF_x_r/MAF_x_r.pop, using rep_opt.workers processes. Other parameters
+	of simuGWAS are taken from gwas_pars. Existing populations are not expanded again.
+	If gwas_pars.burnInGen is positive, the MAF levels of a replicate branch from a shared
+	burn-in, which is saved under burnin_r.ckpt. Return the list of expanded population files.
+	"""
+	MAFs = float_range(rep_opt.MAF_range_hi,rep_opt.MAF_range_lo,rep_opt.MAF_num_steps,logger)
+	seed = master_seed(rep_opt,logger)
+	gwas_opts = gwas_pars.asDict()
+	gwas_opts.pop('expandPop',None)
+	tasks = []
+	branches = {}
+	filenames = []
+	for maf in xrange(len(MAFs)):
+		for maf_rep in xrange(rep_opt.MAF_replicates):
+			maf_dir = "MAF_%.2f_%d" %(MAFs[maf],maf_rep+1)
+			filename = os.path.join(maf_dir,"%s.pop" % maf_dir)
+			filenames.append(filename)
+			if os.path.isfile(filename):
+				if logger:
+					logger.info("Expanded population %s already exists, skipping!" % filename)
+				continue
+			mkdir_p(maf_dir)
+			tasks.append((gwas_opts,MAFs[maf],cell_seed(seed,maf,maf_rep),filename))
+			branches.setdefault(maf_rep,[]).append(tasks[-1][1:])
+	task_func = _expand_task
+	if gwas_pars.burnInGen > 0:
+		# one task for each replicate, with branches for its MAF levels
+		task_func = _branch_task
+		tasks = [(gwas_opts,cell_seed(seed,'burnin',maf_rep),"burnin_%d.ckpt" % (maf_rep+1),branches[maf_rep])
+			for maf_rep in sorted(branches.keys())]
+	if logger:
+		logger.info("Running %d expansion tasks with %d workers" % (len(tasks),rep_opt.workers))
+	if rep_opt.workers > 1 and len(tasks) > 1:
+		import multiprocessing
+		pool = multiprocessing.Pool(min(rep_opt.workers,len(tasks)),_load_init,(gwas_pars.initPop,))
+		for result in pool.imap_unordered(task_func,tasks):
+			pass
+		pool.close()
+		pool.join()
+	elif len(tasks) > 0:
+		_load_init(gwas_pars.initPop)
+		for task in tasks:
+			task_func(task)
+	return filenames
+
 def rep_bash(dirpaths,logger=None,**kwargs):
 	"""
 	Given the list of dirpaths in the replicates, parse out the program name and send
@@ -279,12 +435,88 @@ def rep_bash(dirpaths,logger=None,**kwargs):
 		kwargs['formatters'] = program
 		cline_filenames = get_cline(logger,**kwargs)
 	
+
+_casePop = {}
+
+def _case_control_task(cells):
+	"""
+	Sample the case/control datasets of grid cells (cc, cc_rep, wtr, wtr_rep, grr, grr_rep)
+	from the expanded population in _casePop, which rep_case_control sets up before worker
+	processes are forked. All CC levels of a design are in the same task if rep_opt.nestedCC
+	is set. Return the filenames of the datasets.
+	"""
+	rep_opt = _casePop['rep_opt']
+	cc_opt = _casePop['cc_opt']
+	seed = _casePop['seed']
+	maf,maf_rep,maf_dir = _casePop['maf']
+	loci = _casePop['loci']
+	pools = _casePop['pools']
+	logger = _casePop['logger']
+	nested = None
+	filenames = []
+	for cc,cc_rep,wtr,wtr_rep,grr,grr_rep in cells:
+		cc_dir = "cc_%d_%d" % (rep_opt.CCs[cc],cc_rep+1)
+		wtr_dir = "WTR_%.2f_%d" % (rep_opt.WTRs[wtr],wtr_rep+1)
+		grr_dir = "GRR_%.2f_%d" % (rep_opt.GRRs[grr],grr_rep+1)
+		
+		dirpath = path_maker(maf_dir,cc_dir,wtr_dir,grr_dir)
+		
+		cc_opt.wtr = rep_opt.WTRs[wtr]
+		cc_opt.GRR = rep_opt.GRRs[grr]
+		cc_opt.numControls= int(rep_opt.CCs[cc])
+		cc_opt.sampledPop = os.path.join(dirpath,"sample.pop")
+		cc_opt.seed = cell_seed(seed,maf,maf_rep,cc,cc_rep,wtr,wtr_rep,grr,grr_rep)
+		key = (cc_rep,wtr_rep,grr_rep)
+		if rep_opt.offspringPool == 'replicate' and key not in pools:
+			pools[key] = singleGeneModel.OffspringPool(cc_opt.pop,loci,
+				cell_seed(seed,maf,maf_rep,'pool',*key))
+		if not rep_opt.nestedCC:
+			pop,result = singleGeneModel.sampleCaseControl(cc_opt,logger,pools.get(key))
+		else:
+			design = (cc_rep,wtr,wtr_rep,grr,grr_rep)
+			if nested is None or nested[0] != design:
+				# sample the largest design, and order its controls randomly
+				largest = rep_opt.CCs.index(max(rep_opt.CCs))
+				cc_opt.numControls = int(rep_opt.CCs[largest])
+				cc_opt.seed = cell_seed(seed,maf,maf_rep,'nested',*design)
+				full,result = singleGeneModel.sampleCaseControl(cc_opt,logger,pools.get(key))
+				controls = [i for i,ind in enumerate(full.individuals()) if not ind.affected()]
+				random.Random(cc_opt.seed).shuffle(controls)
+				source = os.path.join(path_maker(maf_dir,"cc_%d_%d" % (rep_opt.CCs[largest],cc_rep+1),
+					wtr_dir,grr_dir),"sample.pop")
+				nested = (design,full,controls,source)
+			design,full,controls,source = nested
+			members = sorted([i for i,ind in enumerate(full.individuals()) if ind.affected()] +
+				controls[:int(rep_opt.CCs[cc])])
+			pop = full.clone()
+			pop.removeIndividuals(indexes=sorted(set(xrange(full.popSize())) - set(members)))
+			out = open(os.path.join(dirpath,"sample.members"),'w')
+			out.write("# indexes of individuals of %s\n" % source)
+			out.write("".join(["%d\n" % x for x in members]))
+			out.close()
+		pop.save(cc_opt.sampledPop)
+		if logger:
+			logger.info("Sampled population saved at %s" %cc_opt.sampledPop)
+		filenames.append(cc_opt.sampledPop)
+	return filenames
+
 def rep_case_control(rep_opt,logger=None):
-	"""Given the gridding scheme options, create simuPOP files in the given subdirectories."""	
+	"""
+	Given the gridding scheme options, create simuPOP files in the given subdirectories.
+	Offspring are shared between datasets of an expanded population as specified by
+	rep_opt.offspringPool. With rep_opt.nestedCC, the datasets of smaller CC levels are
+	nested subsets of the dataset with the largest number of controls.
+	
+	The grid cells of an expanded population are sampled by rep_opt.workers processes,
+	which are forked after the population is loaded. Each cell has its own random seed,
+	derived from the master seed and its coordinates, so the datasets do not depend on
+	the number of workers or the order in which cells are sampled.
+	"""	
 	simuOpt.setOptions(alleleType='binary', optimized=True)
 	from simuPOP import *
 
 	cc_opt = simuOpt.Params(singleGeneModel.options)
+	seed = master_seed(rep_opt,logger)
 	
 	for maf in xrange(len(rep_opt.MAFs)):
 		for maf_rep in xrange(rep_opt.MAF_replicates):
@@ -292,29 +524,32 @@ def rep_case_control(rep_opt,logger=None):
 			maf_dir = "MAF_%.2f_%d" %(rep_opt.MAFs[maf],maf_rep+1)
 			cc_opt.expandPop = "%s/%s.pop" % (maf_dir,maf_dir)
 			cc_opt.pop = 	loadPopulation(cc_opt.expandPop)
-			logger.info("Expanded population %s loaded!" %cc_opt.expandPop)
+			if logger:
+				logger.info("Expanded population %s loaded!" %cc_opt.expandPop)
 
-			for cc in xrange(len(rep_opt.CCs)):
-				for cc_rep in xrange(rep_opt.CC_replicates):
-					cc_dir = "cc_%d_%d" % (rep_opt.CCs[cc],cc_rep+1)
-					for wtr in xrange(len(rep_opt.WTRs)):
-						for wtr_rep in xrange(rep_opt.WTR_replicates):
-							wtr_dir = "WTR_%.2f_%d" % (rep_opt.WTRs[wtr],wtr_rep+1)
-							for grr in xrange(len(rep_opt.GRRs)):
-								for grr_rep in xrange(rep_opt.GRR_replicates):
-									grr_dir = "GRR_%.2f_%d" % (rep_opt.GRRs[grr],grr_rep+1)
-									
-									dirpath = path_maker(maf_dir,cc_dir,wtr_dir,grr_dir)
-									
-									cc_opt.wtr = rep_opt.WTRs[wtr]
-									cc_opt.GRR = rep_opt.GRRs[grr]
-									cc_opt.numControls= rep_opt.CCs[cc]
-									cc_opt.sampledPop = os.path.join(dirpath,"sample.pop")
-									pop = singleGeneModel.penetrance(cc_opt,logger)
-									case_control_dataset.save(pars.sampledPop)
-									logger.info("Sampled population saved at %s" %pars.sampledPop)
-									
-										
+			cells = itertools.product(xrange(len(rep_opt.CCs)),xrange(rep_opt.CC_replicates),
+				xrange(len(rep_opt.WTRs)),xrange(rep_opt.WTR_replicates),
+				xrange(len(rep_opt.GRRs)),xrange(rep_opt.GRR_replicates))
+			if rep_opt.nestedCC:
+				# CC levels of the same design are sampled in one task
+				cells = sorted(cells,key=lambda x:x[1:])
+				tasks = [list(x[1]) for x in itertools.groupby(cells,key=lambda x:x[1:])]
+			else:
+				tasks = [[x] for x in cells]
+			_casePop.update(rep_opt=rep_opt,cc_opt=cc_opt,seed=seed,maf=(maf,maf_rep,maf_dir),
+				loci=singleGeneModel.diseaseLoci(cc_opt),pools={},logger=logger)
+			if rep_opt.workers > 1 and len(tasks) > 1:
+				import multiprocessing
+				# forked workers share the loaded population (copy-on-write)
+				workers = multiprocessing.Pool(min(rep_opt.workers,len(tasks)))
+				for result in workers.imap_unordered(_case_control_task,tasks):
+					pass
+				workers.close()
+				workers.join()
+			else:
+				for task in tasks:
+					_case_control_task(task)
+			_casePop.clear()
 
 if __name__ == '__main__':
 	import logging
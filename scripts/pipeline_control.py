@@ -1,6 +1,6 @@
 import os,sys,logging
 from simuOpt import *
-from DPLSim import loadHapMap3,selectMarkers,singleGeneModel,simuGWAS,format,cline_writer,replicator
+from DPLSim import loadHapMap3,markerList,selectMarkers,singleGeneModel,simuGWAS,format,cline_writer,replicator
 import simuPOP
 
 pipeline_options = [
@@ -56,13 +56,13 @@ def downloadData(logger=None,**kwargs):
 	From Peng and Amos example_2.py
 	This equivalent to command
 
-	> loadHapMap3.py --chroms='[2, 5,10]' --dest=HapMap
+	> loadHapMap3.py --chroms='[2, 5,10]' --dest=HapMap --jobs=1
 	'''
 	options = loadHapMap3.options
 	short_desc = """This script downloads the second release of the phase 3 of the HapMap datasets\n'
 		'and saves them in simuPOP format. It also downloads the fine-scale\n'
 		'recombination map and saves the genetic distance of each marker in\n'
-		'a dictionary (geneticMap) in the population\'s local namespace."""
+		'an array (geneticMap) in the population\'s local namespace."""
 	
 	if len(kwargs) > 0:
 		pars = Params(options,short_desc,kwargs)
@@ -72,23 +72,10 @@ def downloadData(logger=None,**kwargs):
 			sys.exit(1)
 	
 	if not pars.skip:
-		for chrom in pars.chroms:
-			for sample in loadHapMap3.HapMap3_pops:
-				popFile = os.path.join(pars.dest, "HapMap3_%s_chr%d.pop" % (sample, chrom))
-				try:
-					if os.path.isfile(popFile):
-						pop = simuPOP.loadPopulation(popFile)
-						if pop.popSize() == loadHapMap3.HapMap3_pop_sizes[sample]:
-							if logger:
-								logger.info("Skipping existing population %s." % popFile)
-							continue
-				except:
-					print "do or do not, there is no try"# continue to load file
-					pass
-				pop = loadHapMapPop(chrom, sample)
-				if logger:
-					logger.info("Save population to %s." % popFile)
-				pop.save(popFile)
+		summary = loadHapMap3.loadHapMapPops(pars.chroms, loadHapMap3.HapMap3_pops, pars.dest, pars.jobs, logger,
+			pars.cache or os.path.join(pars.dest, 'cache'), pars.mirror, pars.columnar)
+		if len(summary['failed']) > 0 and logger:
+			logger.info("Failed to create populations %s" % ", ".join(summary['failed']))
 
 	return pars
 
@@ -135,14 +122,7 @@ def getInitPop(logger=None,**kwargs):
 	
 	names = []
 	if pars.markerList != '':
-		mlist = open(pars.markerList)
-		for line in mlist.readlines():
-			if line.startswith('#') or line.strip() == '':
-				continue
-			names.append(line.split(',')[0].split()[0])
-		if logger:
-			logger.info('%d markers located from marker list file %s' %\
-				(len(names), pars.markerList))
+		names = markerList.MarkerList(pars.markerList, pars.chroms, logger)
 		
 	pop = selectMarkers.getHapMapMarkers(pars.HapMap_dir, 
 		names = names,
@@ -154,7 +134,8 @@ def getInitPop(logger=None,**kwargs):
 		minAF = pars.minAF,
 		minDist = pars.minDist,
 		mergeSubPops = pars.mergeSubPops,
-		logger=logger)
+		logger=logger,
+		jobs = pars.jobs)
 		
 	if logger:
 		logger.info('Save population to %s and marker list to %s.lst' % \
@@ -163,9 +144,9 @@ def getInitPop(logger=None,**kwargs):
 	selectMarkers.saveMarkerList(pop, pars.filename + '.lst',logger=logger)
 	return pars
 
-def getExpandPop(logger=None,**kwargs):
+def getExpandPars(logger=None,**kwargs):
 	"""
-	Wrapper for simuGWAS.py
+	Return parameters of simuGWAS.py, from kwargs or a dialog.
 	"""
 	options = simuGWAS.options
 	short_desc = '''This program evolves a subset of the HapMap dataset
@@ -178,6 +159,13 @@ def getExpandPop(logger=None,**kwargs):
 		pars = Params(options,short_desc)
 		if not pars.guiGetParam():
 			sys.exit(1)
+	return pars
+
+def getExpandPop(logger=None,**kwargs):
+	"""
+	Wrapper for simuGWAS.py
+	"""
+	pars = getExpandPars(logger,**kwargs)
 	if os.path.isfile(pars.filename):
 		logger.info("Expanded population %s already exists, skipping ahead!" % pars.filename)
 		return pars
@@ -303,9 +291,10 @@ def replicate_mode(pipeline_pars,logger=None):
 	if pipeline_pars.init:
 		init_pop_pars =getInitPop(logger)
 	
-	#Need to work on this for cases where multiple MAF are used
+	# one expanded population for each MAF level and replicate
 	if pipeline_pars.expand:
-		expand_pop_pars = getExpandPop(logger)
+		expand_pop_pars = getExpandPars(logger)
+		replicator.rep_expand(rep_opt,expand_pop_pars,logger)
 	
 	if pipeline_pars.penetrance:
 		replicator.rep_case_control(rep_opt,logger) 
@@ -36,9 +36,115 @@ simuOpt.setOptions(alleleType='binary', quiet=True, version='1.0.1')
 from simuPOP import *
 
 from types import *
-import os, sys, exceptions
+import os, sys, exceptions, bisect, array
 
-def mergeHapMapPops(HapMap_dir, HapMap_pops, chrom, logger=None):
+import geneticMap, hapStore, markerList
+
+# translation table that swaps allele codes 0 and 1
+_swapAlleles = '\x01\x00' + ''.join([chr(x) for x in range(2, 256)])
+
+def _mergePlan(stores, startPos=0, endPos=0, logger=None):
+    '''Find markers between startPos and endPos that are common to all stores
+    and determine how their alleles should be recoded, using only indexes of
+    stores. Return a list of locus indexes in each store, merged allele
+    names of these loci, and a list of loci at which alleles 0 and 1 should
+    be swapped for each store.'''
+    windows = [store.locusRange(startPos, endPos) for store in stores]
+    index = [dict([(store.names[x], x) for x in range(*window)]) for store, window in zip(stores, windows)]
+    common = [x for x in stores[0].names[windows[0][0]:windows[0][1]] if False not in [x in idx for idx in index[1:]]]
+    for store, idx in zip(stores, index):
+        if len(idx) > len(common) and logger:
+            logger.info('Removing %d markers (%.2f percent) from population %s' % \
+                (len(idx) - len(common), (len(idx) - len(common))*100./len(idx), store.subPop))
+    loci = [[idx[x] for x in common] for idx in index]
+    alleleNames = []
+    swap = [[] for store in stores]
+    for i, name in enumerate(common):
+        names = [store.alleleNames[loc[i]] for store, loc in zip(stores, loci)]
+        alleles = set()
+        for x in names:
+            alleles |= set(x)
+        alleles = list(alleles)
+        alleles.sort()
+        if len(alleles) > 2:
+            raise exceptions.ValueError("Do not know how to recode alleles. Alleles "
+                "for locus %s in different populations are %s. This is usually "
+                "caused by the use of data from different HapMap versions." % \
+                (name, ', '.join([str(x) for x in names])))
+        alleleNames.append(alleles)
+        # a monomorphic locus with the second allele is recoded from 0 to 1
+        for k, x in enumerate(names):
+            if alleles.index(x[0]) == 1:
+                swap[k].append(i)
+    return loci, alleleNames, swap
+
+
+def _mergeStores(stores, startPos=0, endPos=0, logger=None):
+    '''Create a population with all individuals of stores and their common
+    markers between startPos and endPos, recoded if necessary. Each store
+    becomes a subpopulation.'''
+    loci, alleleNames, swap = _mergePlan(stores, startPos, endPos, logger)
+    first = stores[0]
+    pop = Population(size=[store.numInds for store in stores], ploidy=2,
+        loci=[len(alleleNames)], lociPos=[first.pos[x] for x in loci[0]],
+        lociNames=[first.names[x] for x in loci[0]], chromNames=[first.chrom],
+        alleleNames=alleleNames, subPopNames=[store.subPop for store in stores])
+    numLoci = len(alleleNames)
+    ind_base = 0
+    for store, storeLoci, storeSwap in zip(stores, loci, swap):
+        if logger:
+            logger.info('Loading %d markers of HapMap population %s' % (numLoci, store.prefix))
+        numHaps = store.numHaps
+        geno = store.haplotypes(storeLoci)
+        for i in storeSwap:
+            geno[i * numHaps:(i + 1) * numHaps] = geno[i * numHaps:(i + 1) * numHaps].translate(_swapAlleles)
+        for idx in range(store.numInds):
+            ind = pop.individual(ind_base + idx)
+            for ploidy in range(2):
+                ind.setGenotype(list(geno[idx * 2 + ploidy::numHaps]), ploidy)
+        ind_base += store.numInds
+        store.close()
+    if first.geneticMap is not None:
+        pop.dvars().geneticMap = array.array('d', [first.geneticMap[x] for x in loci[0]])
+    if first.info.has_key('HapMap_rel'):
+        pop.dvars().HapMap_rel = int(first.info['HapMap_rel'])
+    return pop
+
+
+def _regionEnd(stores, startPos, numMarkers, names=[], minDist=0):
+    '''Return the position of the last of numMarkers markers after startPos
+    that getHapMapMarkers would select from the merged population, using
+    only the indexes of stores. Return 0 if there are not enough markers.
+    Markers of other stores are located by binary search on position, so
+    only markers before the end of the region are examined.'''
+    def inStore(store, name, pos):
+        loc = bisect.bisect_left(store.pos, pos)
+        while loc < len(store.pos) and store.pos[loc] == pos:
+            if store.names[loc] == name:
+                return True
+            loc += 1
+        return False
+    first, last = stores[0].locusRange(startPos)
+    count = 0
+    lastPos = 0
+    for loc in range(first, last):
+        pos = stores[0].pos[loc]
+        name = stores[0].names[loc]
+        if len(names) != 0 and name not in names:
+            continue
+        if False in [inStore(store, name, pos) for store in stores[1:]]:
+            continue
+        if lastPos > 0 and pos - lastPos < minDist:
+            continue
+        count += 1
+        lastPos = pos
+        if count == numMarkers:
+            return pos
+    return 0
+
+
+def mergeHapMapPops(HapMap_dir, HapMap_pops, chrom, logger=None, startPos=0,
+        endPos=0, numMarkers=0, names=[], minDist=0):
     '''
     Load HapMap dataset for multiple populations and merge them.
     The important step is to find a common set of markers and make sure
@@ -56,11 +162,29 @@ def mergeHapMapPops(HapMap_dir, HapMap_pops, chrom, logger=None):
 
     logger
         A logger to record what is going on.
+
+    startPos, endPos, numMarkers, names, minDist
+        If all populations are also saved in columnar format (.hap and .idx
+        files written by loadHapMap3.py), only markers between startPos and
+        endPos are loaded. If endPos is unspecified, the region ends at the
+        numMarkers-th marker (among markers in names and at least minDist
+        apart) common to all populations. In this case, common markers and
+        allele coding are determined from the indexes of all populations
+        before any genotype is loaded. Otherwise, whole populations are
+        loaded and merged one by one.
     '''
+    prefixes = [os.path.join(HapMap_dir, '%s_chr%d' % (HapMap_pop, chrom)) for HapMap_pop in HapMap_pops]
+    if False not in [hapStore.storeExists(x) for x in prefixes]:
+        stores = [hapStore.HapStore(x) for x in prefixes]
+        try:
+            if endPos == 0 and numMarkers > 0:
+                endPos = _regionEnd(stores, startPos, numMarkers, names, minDist)
+            return _mergeStores(stores, startPos, endPos, logger)
+        finally:
+            for store in stores:
+                store.close()
     pop = None
-    for HapMap_pop in HapMap_pops:
-        filename = os.path.join(HapMap_dir, '%s_chr%d.pop' % \
-            (HapMap_pop, chrom))
+    for filename in [x + '.pop' for x in prefixes]:
         if logger:
             logger.info('Loading HapMap population %s' % filename)
         pop1 = loadPopulation(filename)
@@ -77,12 +201,12 @@ def mergeHapMapPops(HapMap_dir, HapMap_pops, chrom, logger=None):
             if logger:
                 logger.info('Removing %d markers (%.2f percent) from population %s' % \
                     (len(remove1), len(remove1)*100./pop.totNumLoci(), pop.subPopNames()))
-            pop.removeLoci([pop.locusByName(x) for x in remove1])
+            geneticMap.removeLoci(pop, [pop.locusByName(x) for x in remove1])
         if len(remove2) > 0:
             if logger:
                 logger.info('Removing %d markers (%.2f percent) from population %s' % \
                     (len(remove2), len(remove2)*100./pop1.totNumLoci(), pop1.subPopNames()))
-            pop1.removeLoci([pop1.locusByName(x) for x in remove2])
+            geneticMap.removeLoci(pop1, [pop1.locusByName(x) for x in remove2])
         # we need to recode alleles if there is one allele in one population and 
         # two alleles in another one at some loci.
         pop_loci = {0:[], 1:[]}
@@ -127,9 +251,87 @@ def mergeHapMapPops(HapMap_dir, HapMap_pops, chrom, logger=None):
 
 
 
+def _chromMarkers(HapMap_dir, HapMap_pops, ch, names=[], startPos=0, endPos=0,
+        numMarkers=0, minAF=0, minDist=0, logger=None):
+    '''
+    Return a population with markers selected from chromosome ch of
+    specified HapMap populations, or None if no qualified marker is found.
+    startPos, endPos and numMarkers are ignored if they are zero. names
+    should be a set. Please refer to getHapMapMarkers for details of the
+    parameters.
+
+    The region between startPos and endPos is located by binary search and
+    allele frequencies are calculated, in chunks, only for markers in this
+    region, so the cost depends on the size of the region, not the size
+    of the chromosome.
+    '''
+    # with minAF, the number of markers in a region cannot be determined
+    # before the population is loaded
+    chPop = mergeHapMapPops(HapMap_dir, HapMap_pops, ch, logger,
+        startPos = startPos, endPos = endPos,
+        numMarkers = minAF == 0 and numMarkers or 0,
+        names = names, minDist = minDist)
+    pos = chPop.lociPos()
+    first = bisect.bisect_left(pos, startPos)
+    last = endPos > 0 and bisect.bisect_right(pos, endPos) or len(pos)
+    # Trim markers by marker names
+    if len(names) != 0:
+        if logger:
+            logger.info("Select markers using a list of %d markers from chromosome %s..." % (len(names), ch))
+        lociNames = chPop.lociNames()
+        candidates = [loc for loc in xrange(first, last) if lociNames[loc] in names]
+    else:
+        candidates = range(first, last)
+    # Trim by minimal distance, allele frequency and number of markers
+    indexes = []
+    lastPos = 0
+    for chunk in range(0, len(candidates), 1000):
+        if numMarkers > 0 and len(indexes) >= numMarkers:
+            break
+        loci = candidates[chunk:chunk + 1000]
+        if minAF > 0:
+            stat(chPop, alleleFreq=loci)
+            freq = chPop.dvars().alleleFreq
+        for loc in loci:
+            if lastPos > 0 and pos[loc] - lastPos < minDist:
+                continue
+            if minAF > 0:
+                maf = min(freq[loc][0], 1 - freq[loc][0])
+                if maf < minAF:
+                    continue
+            if numMarkers > 0 and len(indexes) >= numMarkers:
+                break
+            indexes.append(loc)
+            lastPos = pos[loc]
+    if len(indexes) == 0:
+        if logger:
+            logger.info('No qualified marker is found on chromosome %d ' % ch)
+        return None
+    if logger:
+        logger.info('%s markers are found on chromosome %d ' % (len(indexes), ch))
+    geneticMap.removeLoci(chPop, keep=indexes)
+    return chPop
+
+
+def _chromMarkersTask(args):
+    '''
+    Select markers from one chromosome as a task of the process pool used
+    by getHapMapMarkers. args are the parameters of _chromMarkers followed
+    by a filename, to which the population is saved. Return the filename,
+    or None if no qualified marker is found.
+    '''
+    import logging
+    chPop = _chromMarkers(*args[:-1],
+        logger=logging.getLogger('selectMarkers.chr%d' % args[2]))
+    if chPop is None:
+        return None
+    chPop.save(args[-1])
+    return args[-1]
+
+
 def getHapMapMarkers(HapMap_dir, names = [], chroms=[], HapMap_pops=['HapMap2_CEU'],
         startPos = [], endPos = [], numMarkers = [], minAF = 0, minDist = 0,
-        mergeSubPops = True, logger=None):
+        mergeSubPops = True, logger=None, jobs=1):
     '''
     Return a population with specified HapMap markers.
 
@@ -138,8 +340,8 @@ def getHapMapMarkers(HapMap_dir, names = [], chroms=[], HapMap_pops=['HapMap2_CE
         loadHapMap2.py or loadHapMap3.py from the simuPOP cookbook.
 
     names
-        (Optional) A list of marker names. If given, only markers in this
-        list will be selected.
+        (Optional) A list of marker names, or a markerList.MarkerList. If
+        given, only markers in this list will be selected.
 
     chroms
         A list of chromosomes to look in. If empty, all 22 autosomes
@@ -164,6 +366,10 @@ def getHapMapMarkers(HapMap_dir, names = [], chroms=[], HapMap_pops=['HapMap2_CE
 
     logger
         A logger to record what is going on.
+
+    jobs
+        Number of processes used to select markers from different
+        chromosomes. The result is identical to that of a single process.
     '''
     def paramExpandList(param, size, err=''):
         '''If parameter param is
@@ -186,63 +392,62 @@ def getHapMapMarkers(HapMap_dir, names = [], chroms=[], HapMap_pops=['HapMap2_CE
         chs = range(1, 23)
     else:
         chs = chroms
+    # hash index of marker names, built once for all chromosomes
+    if isinstance(names, (list, tuple)):
+        names = set(names)
     # read in HapMap data file
     pop = None
-    geneticMap = {}
+    gmap = array.array('d')
     sPos = paramExpandList(startPos, len(chs), 'Incorrect starting position')
     ePos = paramExpandList(endPos, len(chs), 'Incorrect ending position')
     nMarkers = paramExpandList(numMarkers, len(chs), 'Incorrect number of markers')
-    #
-    for chIdx, ch in enumerate(chs):
-        markers = []
-        chPop = mergeHapMapPops(HapMap_dir, HapMap_pops, ch, logger)
-        # Trim markers by marker names
-        if len(names) != 0:
+    tasks = [(HapMap_dir, HapMap_pops, ch, names,
+        len(sPos) > 0 and sPos[chIdx] or 0,
+        len(ePos) > 0 and ePos[chIdx] or 0,
+        len(nMarkers) > 0 and nMarkers[chIdx] or 0,
+        minAF, minDist) for chIdx, ch in enumerate(chs)]
+    parallel = jobs > 1 and len(chs) > 1
+    if parallel:
+        import tempfile, shutil
+        tmpdir = tempfile.mkdtemp()
+    try:
+        if parallel:
+            # chromosomes are processed by a pool of processes and saved to
+            # temporary files, which are loaded in the order of chromosomes
+            import multiprocessing
             if logger:
-                logger.info("Select markers using a list of %d markers from chromosome %s..." % (len(names), ch))
-            chPop.removeLoci(keep = chPop.lociByNames(list(set(chPop.lociNames()) & set(names))))
+                logger.info('Selecting markers from %d chromosomes using %d processes' % \
+                    (len(chs), min(jobs, len(chs))))
+            pool = multiprocessing.Pool(min(jobs, len(chs)))
+            chFiles = pool.map(_chromMarkersTask,
+                [x + (os.path.join(tmpdir, 'chr%d.pop' % x[2]),) for x in tasks], chunksize=1)
+            pool.close()
+            pool.join()
+            chPops = (x is not None and loadPopulation(x) or None for x in chFiles)
+        else:
+            chPops = (_chromMarkers(*x, logger=logger) for x in tasks)
         #
-        if chPop.totNumLoci() == 0:
-            continue
-        if minAF > 0:
-            stat(chPop, alleleFreq=range(chPop.totNumLoci()))
-        # Trim by start, end position ...
-        indexes = []
-        lastPos = 0
-        for loc in range(chPop.totNumLoci()):
-            pos = chPop.locusPos(loc)
-            if len(sPos) > 0 and pos < sPos[chIdx]:
+        for chPop in chPops:
+            if chPop is None:
                 continue
-            if len(ePos) > 0 and pos > ePos[chIdx]:
-                continue
-            if lastPos > 0 and pos - lastPos < minDist:
-                continue
-            if minAF > 0:
-                maf = chPop.dvars().alleleFreq[loc][0]
-                maf = min(maf, 1 - maf)
-                if maf < minAF:
-                    continue
-            if len(nMarkers) > 0 and len(indexes) >= nMarkers[chIdx]:
-                break
-            indexes.append(loc)
-            lastPos = pos
-        if len(indexes) > 0:
-            if logger:
-                logger.info('%s markers are found on chromosome %d ' % (len(indexes), ch))
-            chPop.removeLoci(keep=indexes)
-            geneticMap.update(chPop.dvars().geneticMap)
+            # genetic map of all chromosomes, in the order of loci
+            chMap = geneticMap.mapOf(chPop)
+            if chMap is None or gmap is None:
+                gmap = None
+            else:
+                gmap.extend(chMap)
             chPop.vars().clear()
             if pop is None:
                 pop = chPop
             else:
                 pop.addChromFrom(chPop)
-        else:
-            if logger:
-                logger.info('No qualified marker is found on chromosome %d ' % ch)
-            del chPop
+    finally:
+        if parallel:
+            shutil.rmtree(tmpdir)
     if pop.numSubPop() > 1 and mergeSubPops:
         pop.mergeSubPops(range(pop.numSubPop()))
-    pop.dvars().geneticMap = geneticMap
+    if gmap is not None:
+        pop.dvars().geneticMap = gmap
     return pop
 
 def saveMarkerList(pop, filename, logger=None):
@@ -292,7 +497,8 @@ options = [
     'default': 'hh550v3_snptable.txt',
     'label': 'Marker list file',
     'description': '''A file with a list of marker names. If there are more than
-        one fields at a line, the rest of them are ignored.''',
+        one fields at a line, the second field is used as chromosome if
+        possible, and the rest of them are ignored.''',
     'allowedTypes': [StringType],
     'validate': simuOpt.valueOr(simuOpt.valueEqual(''), simuOpt.valueValidFile()),
     },
@@ -363,6 +569,16 @@ options = [
     'allowedTypes': [BooleanType],
     },
     {
+    'longarg': 'jobs=',
+    'default': 1,
+    'useDefault': True,
+    'label': 'Number of parallel jobs',
+    'description': '''Number of processes used to select markers from
+        different chromosomes in parallel.''',
+    'allowedTypes': [IntType],
+    'validate': simuOpt.valueGE(1),
+    },
+    {
     'longarg': 'filename=',
     'label': 'Filename to save population',
     'default': 'init.pop',
@@ -387,17 +603,7 @@ if __name__ == '__main__':
         sys.exit(1)
     names = []
     if pars.markerList != '':
-        mlist = open(pars.markerList)
-        for line in mlist.readlines():
-            if line.startswith('#') or line.strip() == '':
-                continue
-            names.append(line.split(',')[0].split()[0])
-        if logger:
-            logger.info('%d markers located from marker list file %s' %\
-                (len(names), pars.markerList))
-        else:
-        	print '%d markers located from marker list file %s' %\
-                (len(names), pars.markerList)
+        names = markerList.MarkerList(pars.markerList, pars.chroms, logger)
     #
     pop = getHapMapMarkers(pars.HapMap_dir, 
         names = names,
@@ -409,7 +615,8 @@ if __name__ == '__main__':
         minAF = pars.minAF,
         minDist = pars.minDist,
         mergeSubPops = pars.mergeSubPops,
-        logger=logger)
+        logger=logger,
+        jobs = pars.jobs)
     if logger:
         logger.info('Save population to %s and marker list to %s.lst' % \
             (pars.filename, pars.filename))
@@ -40,7 +40,9 @@ from simuPOP import *
 
 from simuPOP.utils import simulateForwardTrajectory, simulateBackwardTrajectory, migrSteppingStoneRates
 
-import os, sys, math, types, time
+import os, sys, math, types, time, cPickle, random
+
+import geneticMap
 
 options = [
     {'longarg': 'initPop=',
@@ -99,7 +101,8 @@ options = [
             loci are 1M bp apart, the recombination rate will be 1e6 x 1e-8 (default
             value), namely 1e-2 times scaling parameter. (This is roughly 0.01 
             per cM). If a variable 'geneticMap' that stores the genetic map of each
-            locus exists in this population, the genetic map will be used.''', 
+            locus (an array('d') in the order of loci) exists in this population, the
+            genetic map will be used.''', 
      'validate': simuOpt.valueGE(0),
     },
     {'longarg': 'scale=',
@@ -161,6 +164,18 @@ options = [
      'allowedTypes': [types.IntType, types.FloatType],
      'validate':    simuOpt.valueBetween(0,1)
     },
+    {'longarg': 'burnInGen=',
+     'default': 0,
+     'useDefault': True,
+     'label': 'Shared burn-in generations',
+     'description': '''Number of generations, out of expandGen, that are evolved
+                without controlling the allele frequency of DPL and are shared by
+                several scenarios (function simuGWASBranches). The allele frequency
+                trajectories of DPL start after these generations. This parameter
+                is not used by function simuGWAS.''',
+     'allowedTypes': [types.IntType, types.LongType],
+     'validate': simuOpt.valueGE(0)
+    },
     {'separator': 'Disease information'},
     {'longarg': 'DPL=',
      'default': ["rs4491689"],
@@ -192,6 +207,25 @@ options = [
                 A backward method assumes that the mutants are relatively new (less than
                 expandGen) so the exiting alleles are cleared and will be introduced later.''',
     },
+    {'longarg': 'trajCache=',
+     'default': '',
+     'useDefault': True,
+     'label': 'Trajectory cache directory',
+     'allowedTypes': [types.StringType],
+     'description': '''If specified, a pool of trajectories simulated with the same
+                demographic model, fitness and allele frequencies is saved to this
+                directory and shared by later simulations, each of which uses a
+                trajectory randomly drawn from the pool.''',
+    },
+    {'longarg': 'trajPoolSize=',
+     'default': 10,
+     'useDefault': True,
+     'label': 'Size of trajectory pool',
+     'allowedTypes': [types.IntType, types.LongType],
+     'description': '''Number of trajectories in a trajectory pool, used only when
+                trajCache is specified.''',
+     'validate': simuOpt.valueGT(0)
+    },
     {'longarg': 'fitness=',
      'default': [1, 0.996, 0.994],
      'useDefault': True,
@@ -226,6 +260,75 @@ options = [
      'allowedTypes': [types.StringType],
      'chooseOneOf': [ 'additive', 'multiplicative', 'interaction', 'none']
     },
+    {'separator': 'Monitoring'},
+    {'longarg': 'monitor=',
+     'default': 'full',
+     'useDefault': True,
+     'label': 'Monitoring statistics',
+     'allowedTypes': [types.StringType],
+     'chooseOneOf': ['off', 'DPL', 'full'],
+     'description': '''Statistics reported during evolution. off: nothing is
+                calculated or reported. DPL: population size and allele frequency
+                at DPL. full: also F_st calculated from all loci if there are more
+                than one subpopulations, which is expensive for large populations
+                and is therefore calculated at most every 10 generations.''',
+    },
+    {'longarg': 'monitorStep=',
+     'default': 1,
+     'useDefault': True,
+     'label': 'Monitoring interval',
+     'allowedTypes': [types.IntType, types.LongType],
+     'description': '''Report statistics every N (scaled) generations.''',
+     'validate': simuOpt.valueGT(0)
+    },
+    {'separator': 'Checkpoint'},
+    {'longarg': 'seed=',
+     'default': 0,
+     'useDefault': True,
+     'label': 'Random number seed',
+     'allowedTypes': [types.IntType, types.LongType],
+     'description': '''Seed of the random number generator. If zero, a random
+                seed will be used and recorded in checkpoints. With the same seed
+                and parameters, a resumed simulation gives the same result as an
+                uninterrupted one.''',
+     'validate': simuOpt.valueGE(0)
+    },
+    {'longarg': 'checkpointGen=',
+     'default': 0,
+     'useDefault': True,
+     'label': 'Checkpoint every N generations',
+     'allowedTypes': [types.IntType, types.LongType],
+     'description': '''If positive, the population is evolved in segments of this
+                number of (scaled) generations and saved to a checkpoint after each
+                segment. The random number generator is reseeded at the beginning of
+                each segment so the result depends on seed and this parameter.''',
+     'validate': simuOpt.valueGE(0)
+    },
+    {'longarg': 'checkpointMinutes=',
+     'default': 0,
+     'useDefault': True,
+     'label': 'Checkpoint every N minutes',
+     'allowedTypes': [types.IntType, types.LongType, types.FloatType],
+     'description': '''If positive, save a checkpoint at the end of a segment if
+                this number of minutes has passed since the last checkpoint. Segments
+                have 10 generations if checkpointGen is unspecified.''',
+     'validate': simuOpt.valueGE(0)
+    },
+    {'longarg': 'checkpointDir=',
+     'default': '',
+     'useDefault': True,
+     'label': 'Checkpoint directory',
+     'allowedTypes': [types.StringType],
+     'description': '''Directory to save checkpoints, default to filename.ckpt.''',
+    },
+    {'longarg': 'resume',
+     'default': False,
+     'useDefault': True,
+     'label': 'Resume from checkpoint',
+     'allowedTypes': [types.BooleanType],
+     'description': '''Continue the simulation from the latest checkpoint in
+                checkpointDir, if there is one.''',
+    },
     {'name':"run_mode",
     'default':"Now",
     'type': ('chooseOneOf', ['Now', 'Bash Script']),
@@ -267,8 +370,186 @@ def Ne(demoFunc, pars):
         ne += 1./sum(demoFunc(i))
     return int(pars.expandGen / ne)
 
+def DPLTrajectory(pars, pop, demoFunc, logger=None, beginGen=0, seed=0):
+    '''Simulate the trajectory of allele frequencies at DPL pars.DPL_idx from
+    generation beginGen. Return None if there is no DPL. Existing mutants at
+    DPL are cleared if a backward trajectory is simulated. seed determines
+    the trajectory drawn from a trajectory pool (see cachedTrajectory).'''
+    if len(pars.DPL) == 0:
+        return None
+    numDPL = len(pars.DPL)
+    # curAlleleFreq expand 0.5 -> [0.5,0.5,...]
+    if len(pars.curAlleleFreq) == 1:
+        pars.curAlleleFreq = pars.curAlleleFreq * numDPL
+    # fitness
+    if pars.mlSelModel == 'none':
+        if numDPL > 1:
+            raise ValueError('A multi-locus selection model is needed if multiple disease predisposing loci are specified.')
+        if len(pars.fitness) != 3:
+            raise ValueError('Fitness value should have three elemenst. %s given.' % (pars.fitness,))
+        fitness = pars.fitness
+    elif pars.mlSelModel == 'interaction':
+        if numDPL == 1:
+            raise ValueError("Interaction model can only be used with more than one DPL");
+        if len(pars.fitness) != 3**numDPL:
+            raise ValueError("Please specify 3^n fitness values for n DPL");
+        fitness = pars.fitness
+    else:
+        if pars.fitness == []:    # neutral process
+            fitness = [1,1,1]*numDPL
+        else:
+            # for a single DPL
+            if len(pars.fitness) == 3:
+                fitness = pars.fitness*numDPL
+            elif len(pars.fitness) == numDPL*3:
+                fitness = pars.fitness
+            else:
+                raise ValueError("Please specify fitness for each DPL")
+    #
+    if pars.trajectory == 'forward':
+        # has to be all backward or all forward
+        stat(pop, alleleFreq=pars.DPL_idx, vars='alleleFreq_sp')
+        currentFreq = []
+        # in the order: LOC0: sp0, sp1, sp2, LOC1: sp0, sp1, sp2, ...
+        for sp in range(pop.numSubPop()):
+            for idx,loc in enumerate(pars.DPL_idx):
+                currentFreq.append(pop.dvars(sp).alleleFreq[loc][1])
+        #
+        endFreq=[(x - min(0.01, x/5.), x + min(0.01, x/5., (1-x)/5.)) for x in pars.curAlleleFreq]
+        if logger:
+            logger.info('Simulating trajectory forward in time, from allele frequency %s to frequency (range) %s' % \
+                (currentFreq, endFreq))
+        def simulate():
+            return simulateForwardTrajectory(
+                N=demoFunc,
+                beginGen=beginGen,
+                endGen=pars.expandGen,
+                beginFreq=currentFreq,
+                endFreq=endFreq,
+                nLoci=len(pars.DPL),
+                fitness=fitness,
+                maxAttempts=1000,
+                logger=logger
+            )
+        key = ('forward', beginGen, currentFreq, endFreq)
+    else:
+        # clear existing mutants at these loci
+        pop.recodeAlleles(alleles=[0,0], loci=pars.DPL_idx)
+        if logger:
+            logger.info('Simulating trajectory backward in time, with ending allele frequency %s' % pars.curAlleleFreq)
+        def simulate():
+            return simulateBackwardTrajectory(
+                N=demoFunc,
+                endGen=pars.expandGen,
+                endFreq=pars.curAlleleFreq,
+                nLoci=len(pars.DPL),
+                fitness=fitness,
+                minMutAge=1,
+                maxMutAge=pars.expandGen - beginGen,
+                logger=logger
+            )
+        key = ('backward', beginGen, pars.curAlleleFreq)
+    if pars.trajCache:
+        key += (fitness, [demoFunc(gen) for gen in range(pars.expandGen)])
+        traj = cachedTrajectory(pars.trajCache, key, simulate, pars.trajPoolSize, logger, seed)
+    else:
+        traj = simulate()
+    if traj is None:
+        raise SystemError('Failed to generated trajectory after 10000 attempts. '
+            'This usually means that the demographic and genetic settings are '
+            'very extreme which makes it very likely for an allele to reach designed'
+            'allele frequency. Please adjust your parameters and try again.')
+    if pars.trajFile:
+        trajFunc = traj.func()
+        out = open(pars.trajFile, 'w')
+        for gen in range(pars.expandGen):
+            print >> out, gen, ' '.join(['%.4f' % x for x in trajFunc(gen)])
+        out.close()
+    return traj
+
+def cachedTrajectory(cacheDir, key, simulate, poolSize, logger=None, seed=0):
+    '''Return a trajectory drawn randomly from a pool of poolSize trajectories
+    simulated by function simulate. The pool is saved in cacheDir under a name
+    determined by key, which should include all parameters of the simulation,
+    and is reused by later calls with the same key. The trajectory is drawn by
+    a random number generator seeded by seed, so that it does not depend on
+    whether the pool had to be simulated. Return None if simulate fails to
+    simulate a trajectory.'''
+    import hashlib
+    filename = os.path.join(cacheDir, 'traj_%s.pickle' % hashlib.md5(repr(key)).hexdigest())
+    pool = []
+    if os.path.isfile(filename):
+        pool = cPickle.load(open(filename, 'rb'))
+    if len(pool) < poolSize:
+        if logger:
+            logger.info('Simulating %d trajectories for trajectory pool %s' % (poolSize - len(pool), filename))
+        while len(pool) < poolSize:
+            traj = simulate()
+            if traj is None:
+                return None
+            pool.append(traj)
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        # several simulations might be writing the same pool
+        tmpfile = '%s.%d.tmp' % (filename, os.getpid())
+        out = open(tmpfile, 'wb')
+        cPickle.dump(pool, out, 2)
+        out.close()
+        os.rename(tmpfile, filename)
+    elif logger:
+        logger.info('Using trajectory pool %s' % filename)
+    return pool[random.Random(seed).randrange(len(pool))]
+
+def segmentSeed(seed, gen):
+    '''Return the seed of the random number generator for the segment of
+    evolution that starts at generation gen.'''
+    return (seed * 1000003 + gen) % 4294967291 + 1
+
+def latestCheckpoint(ckDir):
+    '''Return the generation of the latest complete checkpoint in ckDir,
+    or None if there is no checkpoint.'''
+    if not os.path.isdir(ckDir):
+        return None
+    gens = [int(x[4:-6]) for x in os.listdir(ckDir) if x.startswith('gen_') and x.endswith('.state')]
+    if len(gens) == 0:
+        return None
+    return max(gens)
+
+def saveCheckpoint(ckDir, pop, state, logger=None):
+    '''Save population and state (a dictionary with key gen) to ckDir, and
+    remove older checkpoints. The state file, which is written last, marks a
+    complete checkpoint.'''
+    if not os.path.isdir(ckDir):
+        os.makedirs(ckDir)
+    prefix = os.path.join(ckDir, 'gen_%06d' % state['gen'])
+    pop.save(prefix + '.pop.tmp')
+    os.rename(prefix + '.pop.tmp', prefix + '.pop')
+    out = open(prefix + '.state.tmp', 'wb')
+    cPickle.dump(state, out, 2)
+    out.close()
+    os.rename(prefix + '.state.tmp', prefix + '.state')
+    for x in os.listdir(ckDir):
+        if x.startswith('gen_') and not x.startswith('gen_%06d.' % state['gen']):
+            os.remove(os.path.join(ckDir, x))
+    if logger:
+        logger.info('Checkpoint saved at generation %d to %s' % (state['gen'], ckDir))
+
+def loadCheckpoint(ckDir, gen):
+    '''Return the population and state saved at generation gen in ckDir.'''
+    prefix = os.path.join(ckDir, 'gen_%06d' % gen)
+    state = cPickle.load(open(prefix + '.state', 'rb'))
+    return loadPopulation(prefix + '.pop'), state
+
 def simuGWAS(pars, pop, logger=None):
     '''The main program'''
+    return evolveExpansion(pars, pop, logger)[0]
+
+def evolveExpansion(pars, pop, logger=None, burnIn=False, branchFrom=None):
+    '''Evolve pop as described by pars and return the expanded population and
+    the state of the simulation. If burnIn is True, evolve only the first
+    pars.burnInGen generations without controlling the allele frequency of
+    DPL. If branchFrom is the state of such a burn-in, pop is the population
+    of the burn-in and it is evolved for the remaining generations.'''
     # record the starting time:if expand("%") == ""|browse confirm w|else|confirm w|endif
     #
     startTime = time.time()
@@ -280,8 +561,19 @@ def simuGWAS(pars, pop, logger=None):
     pars.fitness = [1 + (x-1) * pars.scale for x in pars.fitness]
     pop.dvars().scale = pars.scale
     #
-    if pars.initSize == 0:
-        demoFunc = expDemoFunc(pop.subPopSizes(), pars.expandSize, pars.expandGen)
+    ckDir = pars.checkpointDir or (pars.filename or 'simuGWAS') + '.ckpt'
+    ckGen = None
+    if pars.resume:
+        ckGen = latestCheckpoint(ckDir)
+    if ckGen is not None:
+        if logger:
+            logger.info('Resuming simulation from checkpoint at generation %d in %s' % (ckGen, ckDir))
+        pop, state = loadCheckpoint(ckDir, ckGen)
+        N0 = state['N0']
+    elif branchFrom is not None:
+        N0 = branchFrom['N0']
+    elif pars.initSize == 0:
+        N0 = pop.subPopSizes()
     else:
         if type(pars.initSize) in [type(()), type([])] and len(pars.initSize) != pop.numSubPop():
             raise ValueError('If initial population size is specified, it should be specified for all subpopulations.')
@@ -291,122 +583,65 @@ def simuGWAS(pars, pop, logger=None):
         else:
             if type(pars.initSize) in [type(0), type(0L)]:
                 pars.initSize = [pars.initSize*1.0*x/pop.popSize() for x in pop.subPopSizes()]
-        demoFunc = expDemoFunc(pars.initSize, pars.expandSize, pars.expandGen)
+        N0 = pars.initSize
+    demoFunc = expDemoFunc(N0, pars.expandSize, pars.expandGen)
     if logger:
         logger.info('Expected effective population size at generation %d is %d' %
             (pars.expandGen, Ne(demoFunc, pars)))
 
     #
+    # the state of the random number generator is determined by seed and
+    # generation, because it is reseeded at the beginning of each segment
+    if ckGen is None:
+        seed = pars.seed
+        if seed == 0:
+            seed = getRNG().seed()
+        else:
+            getRNG().set(seed=seed)
+        segment = pars.checkpointGen
+        if segment == 0 and pars.checkpointMinutes > 0:
+            segment = 10
+        state = {'gen': 0, 'N0': list(N0), 'seed': seed, 'segment': segment, 'traj': None, 'nextID': 0}
+        if branchFrom is not None:
+            state['gen'] = branchFrom['gen']
+            state['nextID'] = branchFrom.get('nextID', 0)
+        if logger:
+            logger.info('Random number seed is %d' % seed)
+    # generations to evolve
+    endGen = pars.expandGen
+    if burnIn:
+        endGen = int(pars.burnInGen / pars.scale)
+    #
     # define a trajectory function
     pars.DPL_idx = pop.lociByNames(pars.DPL)
-    if len(pars.DPL) > 0:
-        numDPL = len(pars.DPL)
-        # curAlleleFreq expand 0.5 -> [0.5,0.5,...]
-        if len(pars.curAlleleFreq) == 1:
-            pars.curAlleleFreq = pars.curAlleleFreq * numDPL
-        # fitness
-        if pars.mlSelModel == 'none':
-            if numDPL > 1:
-                raise ValueError('A multi-locus selection model is needed if multiple disease predisposing loci are specified.')
-            if len(pars.fitness) != 3:
-                raise ValueError('Fitness value should have three elemenst. %s given.' % (pars.fitness,))
-            fitness = pars.fitness
-        elif pars.mlSelModel == 'interaction':
-            if numDPL == 1:
-                raise ValueError("Interaction model can only be used with more than one DPL");
-            if len(pars.fitness) != 3**numDPL:
-                raise ValueError("Please specify 3^n fitness values for n DPL");
-            fitness = pars.fitness
-        else:
-            if pars.fitness == []:    # neutral process
-                fitness = [1,1,1]*numDPL
-            else:
-                # for a single DPL
-                if len(pars.fitness) == 3:
-                    fitness = pars.fitness*numDPL
-                elif len(pars.fitness) == numDPL*3:
-                    fitness = pars.fitness
-                else:
-                    raise ValueError("Please specify fitness for each DPL")
-        #
+    if ckGen is None and not burnIn:
+        state['traj'] = DPLTrajectory(pars, pop, demoFunc, logger, state['gen'], state['seed'])
+    traj = state['traj']
+    if traj is None:
+        trajFunc = None
+        introOps = []
+        trajLoci = []
+    else:
+        trajFunc = traj.func()
+        trajLoci = pars.DPL_idx
         if pars.trajectory == 'forward':
-            # has to be all backward or all forward
-            stat(pop, alleleFreq=pars.DPL_idx, vars='alleleFreq_sp')
-            currentFreq = []
-            # in the order: LOC0: sp0, sp1, sp2, LOC1: sp0, sp1, sp2, ...
-            for sp in range(pop.numSubPop()):
-                for idx,loc in enumerate(pars.DPL_idx):
-                    currentFreq.append(pop.dvars(sp).alleleFreq[loc][1])
-            #
-            endFreq=[(x - min(0.01, x/5.), x + min(0.01, x/5., (1-x)/5.)) for x in pars.curAlleleFreq]
-            if logger:
-                logger.info('Simulating trajectory forward in time, from allele frequency %s to frequency (range) %s' % \
-                    (currentFreq, endFreq))
-            traj = simulateForwardTrajectory(
-                N=demoFunc,
-                beginGen=0,
-                endGen=pars.expandGen,
-                beginFreq=currentFreq,
-                endFreq=endFreq,
-                nLoci=len(pars.DPL),
-                fitness=fitness,
-                maxAttempts=1000,
-                logger=logger
-            )
-            introOps = [] 
+            introOps = []
         else:
-            # clear existing mutants at these loci
-            pop.recodeAlleles(alleles=[0,0], loci=pars.DPL_idx)
-            if logger:
-                logger.info('Simulating trajectory backward in time, with ending allele frequency %s' % pars.curAlleleFreq)
-            traj = simulateBackwardTrajectory(
-                N=demoFunc,
-                endGen=pars.expandGen,
-                endFreq=pars.curAlleleFreq,
-                nLoci=len(pars.DPL),
-                fitness=fitness,
-                minMutAge=1,
-                maxMutAge=pars.expandGen,
-                logger=logger
-            )
             introOps = traj.mutators(loci=pars.DPL_idx)
-        if traj is None:
-            raise SystemError('Failed to generated trajectory after 10000 attempts. '
-                'This usually means that the demographic and genetic settings are '
-                'very extreme which makes it very likely for an allele to reach designed'
-                'allele frequency. Please adjust your parameters and try again.')
-        trajFunc = traj.func()
-        if pars.trajFile:
-            out = open(pars.trajFile, 'w')
-            for gen in range(pars.expandGen):
-                print >> out, gen, ' '.join(['%.4f' % x for x in trajFunc(gen)])
-            out.close()
-    else:
-        trajFunc = None
-        introOps = []
     # recombination
-    try:
-        # try to use a genetic map
-        pos = [pop.dvars().geneticMap[pop.locusName(x)] for x in range(pop.totNumLoci())]
-        loc = []
-        rate = []
-        for ch in range(pop.numChrom()):
-            beg = pop.chromBegin(ch)
-            end = pop.chromEnd(ch)
-            loc.extend(range(beg, end - 1))
-            # genetic map use cM/Mb as combined rate so we need to 
-	    # 1e-6 to reset recIntensity.
-            rate.extend([(pos[x+1] - pos[x])*1e6*pars.recIntensity for x in range(beg, end - 1)])
+    pos = geneticMap.mapOf(pop)
+    if pos is not None:
+        # use a genetic map
+        loc, rate = geneticMap.recombinationRates(pop, pars.recIntensity)
         if pars.dumpRec:
             recOp = Recombinator(rates=rate, loci=loc, infoFields='ind_id', output='>>%s' % pars.dumpRec)
         else:
             recOp = Recombinator(rates=rate, loci=loc)
         print 'Scaled recombination at %.3f cM/Mb over %.2f centiMorgan genetic (%.0f bp physical) distance (first chromosome)' % \
-            (pars.recIntensity*1e6, (pop.dvars().geneticMap[pop.locusName(pop.numLoci(0)-1)] - \
-                pop.dvars().geneticMap[pop.locusName(0)]),
+            (pars.recIntensity*1e6, (pos[pop.numLoci(0)-1] - pos[0]),
                 int(pop.locusPos(pop.numLoci(0)-1) - pop.locusPos(0)))
-    except:
-        # if not possible, use a physical map
+    else:
+        # otherwise, use a physical map
         if pars.dumpRec:
             recOp = Recombinator(intensity=pars.recIntensity, infoFields='ind_id', output='>>%s' % pars.dumpRec)
         else:
@@ -424,46 +659,122 @@ def simuGWAS(pars, pop, logger=None):
     #
     pop.dvars().DPL = pars.DPL_idx
     pop.dvars().scale = pars.scale
-    pop.evolve(
-        initOps = [
-            InitSex(),
-            IfElse(pars.dumpRec != '', IdTagger()),
-        ],
-        preOps = [
-            SNPMutator(u=pars.mutaRate, v=pars.mutaRate, loci=range(pop.totNumLoci())),
-            migrOp,
-        ] + introOps,
-        matingScheme = ControlledRandomMating(
-            loci = pars.DPL_idx,
-            alleles = [1]*len(pars.DPL_idx),
-            freqFunc = trajFunc,
-            ops = [
-                IfElse(pars.dumpRec != '', IdTagger()),
-                recOp,
-            ],
-            subPopSize = demoFunc),
-        postOps = [
-            Stat(popSize = True, alleleFreq=pars.DPL_idx, structure=range(pop.totNumLoci())),
+    # statistics to monitor the evolutionary process
+    monitorOps = []
+    if pars.monitor != 'off':
+        monitorOps.extend([
+            Stat(popSize = True, alleleFreq=pars.DPL_idx, step=pars.monitorStep),
             IfElse(len(pars.DPL) != 0,
                 PyEval(r'"After %3d generations, size=%s, freq=%s\n" % ((gen + 1 ) * scale, subPopSize, ", ".join(["%.4f" % alleleFreq[x][1] for x in DPL]))'),
-                PyEval(r'"After %3d generations, size=%s\n" % ((gen + 1 )* scale, subPopSize)')
+                PyEval(r'"After %3d generations, size=%s\n" % ((gen + 1 )* scale, subPopSize)'),
+                step=pars.monitorStep
             ),
-            IfElse(pop.numSubPop() > 1,
-                PyEval(r"'F_st = %.3f\n' % F_st", step=10)),
-            IfElse(pars.haploCount[1] > pars.haploCount[0],
-                ifOps=[
-                    Stat(haploFreq=range(pars.haploCount[0], pars.haploCount[1])),
-                    PyEval(r'"Number of haplotypes between loci %d and %d is %%d\n" %% len(haploNum[%s])' % \
-                        (pars.haploCount[0], pars.haploCount[1], tuple(range(pars.haploCount[0], pars.haploCount[1]))))
+        ])
+    if pars.monitor == 'full' and pop.numSubPop() > 1:
+        monitorOps.extend([
+            Stat(structure=range(pop.totNumLoci()), step=max(pars.monitorStep, 10)),
+            PyEval(r"'F_st = %.3f\n' % F_st", step=max(pars.monitorStep, 10)),
+        ])
+    # evolve in segments, which are all generations if no checkpoint is needed
+    segment = state['segment'] or endGen
+    lastCheckpoint = time.time()
+    # IDs of a resumed or branched run continue from the saved next ID, because
+    # IdTagger restarts from the beginning in a new process
+    startID = state.get('nextID', 0)
+    while state['gen'] < endGen:
+        gens = min(segment, endGen - state['gen'])
+        # reseeded even without checkpoints, so that evolution does not depend on
+        # random numbers used before, e.g. to simulate a trajectory pool
+        getRNG().set(seed=segmentSeed(state['seed'], state['gen']))
+        pop.evolve(
+            initOps = [
+                InitSex(),
+                IfElse(pars.dumpRec != '', IdTagger()),
+            ] if state['gen'] == 0 else [],
+            preOps = [
+                SNPMutator(u=pars.mutaRate, v=pars.mutaRate, loci=range(pop.totNumLoci())),
+                migrOp,
+            ] + introOps,
+            matingScheme = ControlledRandomMating(
+                loci = trajLoci,
+                alleles = [1]*len(trajLoci),
+                freqFunc = trajFunc,
+                ops = [
+                    IfElse(pars.dumpRec != '', IdTagger(startID=startID)),
+                    recOp,
                 ],
-                step=10,
-            ),
-        ],
-        gen = pars.expandGen
-    )
+                subPopSize = demoFunc),
+            postOps = monitorOps + [
+                IfElse(pars.haploCount[1] > pars.haploCount[0],
+                    ifOps=[
+                        Stat(haploFreq=range(pars.haploCount[0], pars.haploCount[1])),
+                        PyEval(r'"Number of haplotypes between loci %d and %d is %%d\n" %% len(haploNum[%s])' % \
+                            (pars.haploCount[0], pars.haploCount[1], tuple(range(pars.haploCount[0], pars.haploCount[1]))))
+                    ],
+                    step=10,
+                ),
+            ],
+            gen = gens
+        )
+        state['gen'] += gens
+        startID = 0
+        if pars.dumpRec != '':
+            state['nextID'] = int(max(pop.indInfo('ind_id'))) + 1
+        if state['gen'] < endGen and ((pars.checkpointGen > 0) or \
+            (pars.checkpointMinutes > 0 and time.time() - lastCheckpoint >= pars.checkpointMinutes * 60)):
+            saveCheckpoint(ckDir, pop, state, logger)
+            lastCheckpoint = time.time()
+    # checkpoints are no longer needed
+    if latestCheckpoint(ckDir) is not None:
+        for x in os.listdir(ckDir):
+            if x.startswith('gen_'):
+                os.remove(os.path.join(ckDir, x))
     if logger:
         logger.info('Simulation finishes in %d seconds.' % (time.time() - startTime))
-    return pop
+    return pop, state
+
+
+def simuGWASBranches(pars, pop, scenarios, logger=None):
+    '''Evolve pop for pars.burnInGen generations without controlling the allele
+    frequency of DPL, and branch the population into scenarios that evolve
+    for the remaining generations. scenarios is a list of dictionaries of
+    parameters that differ from pars, such as curAlleleFreq, fitness, seed and
+    filename. Each expanded population is saved to its filename, and a list
+    of these filenames is returned. If pars.resume is set, the burn-in
+    population saved in checkpoint directory (pars.checkpointDir or
+    pars.filename.ckpt)/burnin is reused.'''
+    if pars.burnInGen <= 0 or pars.burnInGen >= pars.expandGen:
+        raise ValueError('Burn-in generations should be between 0 and expandGen')
+    burnDir = os.path.join(pars.checkpointDir or (pars.filename or 'simuGWAS') + '.ckpt', 'burnin')
+    burnGen = int(pars.burnInGen / pars.scale)
+    if pars.resume and latestCheckpoint(burnDir) == burnGen:
+        if logger:
+            logger.info('Using burn-in population in %s' % burnDir)
+        burnPop, burnState = loadCheckpoint(burnDir, burnGen)
+    else:
+        if pars.trajectory == 'backward':
+            # DPL mutants will be introduced after burn-in
+            pop.recodeAlleles(alleles=[0,0], loci=pop.lociByNames(pars.DPL))
+        burnPars = copyPars(pars, checkpointDir=burnDir)
+        burnPop, burnState = evolveExpansion(burnPars, pop, logger, burnIn=True)
+        saveCheckpoint(burnDir, burnPop, burnState, logger)
+    filenames = []
+    for scenario in scenarios:
+        branchPars = copyPars(pars, checkpointDir='', **scenario)
+        if logger:
+            logger.info('Evolving branch %s from generation %d' % (branchPars.filename, burnState['gen']))
+        branch = evolveExpansion(branchPars, burnPop.clone(), logger, branchFrom=burnState)[0]
+        branch.vars().clear()
+        branch.save(branchPars.filename)
+        filenames.append(branchPars.filename)
+    return filenames
+
+def copyPars(pars, **kwargs):
+    '''Return a copy of parameters pars with values changed by kwargs.'''
+    values = pars.asDict()
+    values.pop('expandPop', None)
+    values.update(kwargs)
+    return simuOpt.Params(options, **values)
 
 
 short_desc = '''This program evolves a subset of the HapMap dataset
@@ -6,53 +6,49 @@ import simuOpt
 simuOpt.setOptions(quiet=True, alleleType='binary', optimized=True)
 from simuPOP import *
 
-import loadHapMap3, selectMarkers, simuGWAS
+import loadHapMap3, markerList, selectMarkers, simuGWAS
 
-def downloadData(logger=None,chroms=[2,5,10],mypops=None):
+def downloadData(logger=None,chroms=[2,5,10],mypops=None,jobs=1,mirror=None):
 	'''
 	Download and create populations from the third phase of the HapMap3 data.
 	By default it grabs all available populations.
 	
 	chroms -- a list of human chromosome numbers. (required)
 	mypops -- a list of HapMap population names. (optional)
+	jobs -- number of processes used to download and import populations. (optional)
+	mirror -- a local mirror of the HapMap FTP servers to download from. (optional)
 	
 	If the directory "HapMap" does not exist in the current directory, it will create one.
 	In the HapMap directory, if a HapMap population file already exists, it will not be overwritten.
+	Downloaded files are kept in HapMap/cache and are not downloaded again.
+	
+	Returns a dictionary listing the population files that are 'built', 'skipped' or 'failed'.
 	
 	From Peng and Amos example_2.py
 	This equivalent to command
 
-	> loadHapMap3.py --chroms='[2, 5,10]' --dest=HapMap
+	> loadHapMap3.py --chroms='[2, 5,10]' --dest=HapMap --jobs=1
 	'''
 	if mypops:
 		for popName in mypops:
 			if popName not in loadHapMap3.HapMap3_pops:
-				logger.info("Population %s not a regognized HapMap population name!" %s)
+				logger.info("Population %s not a regognized HapMap population name!" %popName)
 				return
 	else:
 		mypops = loadHapMap3.HapMap3_pops				
 	
 	if not os.path.isdir('HapMap'):
 		os.mkdir('HapMap')
-		
-	for chrom in chroms:
-		for popName in loadHapMap3.HapMap3_pops:
-			filename = 'HapMap/HapMap3_%s_chr%d.pop' % (popName, chrom)
-			if not os.path.isfile(filename):
-				print "Downloading %s" %filename
-				pop = loadHapMap3.loadHapMapPop(chrom, popName)
-				pop.save(filename)
-			else:
-				if logger:
-					logger.info("File %s is already downloaded! Delete it to re-download." %filename)
-				else:
-					print "File %s is already downloaded! Delete it to re-download." %filename
+	
+	return loadHapMap3.loadHapMapPops(chroms, mypops, 'HapMap', jobs, logger,
+		os.path.join('HapMap', 'cache'), mirror)
 
 def getInitPop(logger=None,chroms=[2,5,10],startPos=[25000000, 25000000, 40000000],
 			numMarkers=[2000, 2000, 2000],
 			nameFile='hh550v3_snptable.txt',
 			savefiles=False,
-			mypops=None):
+			mypops=None,
+			jobs=1):
 	'''
 	Get markers from a specified range in all HapMap populations, return this initialized population.
 	
@@ -63,6 +59,7 @@ def getInitPop(logger=None,chroms=[2,5,10],startPos=[25000000, 25000000, 4000000
 	nameFile -- A file containing the list of marker names to subset from the HapMap project, for example the Illumina 1M chipset.
 	savefiles -- A list of two file names: [population_filename,marker_list_filename]. Nothing saved if False. (optional)
 	mypops -- A list of HapMap3 population names, in the format such as 'HapMap_CEU'. (optional)
+	jobs -- number of processes used to select markers from different chromosomes. (optional)
 	
 	Returns the initial population in simuPOP format, merged across all mypops for the selected markers.
 	
@@ -88,11 +85,7 @@ def getInitPop(logger=None,chroms=[2,5,10],startPos=[25000000, 25000000, 4000000
 
 	names = []
 	if nameFile:
-		ann = open(nameFile)
-		if logger:
-			logger.info('Loading marker names from %s' %s)
-		for line in ann:
-			names.append(line.split('\t')[0])
+		names = markerList.MarkerList(nameFile, chroms, logger)
  
 	initpop = selectMarkers.getHapMapMarkers(
 		names=names,
@@ -102,7 +95,8 @@ def getInitPop(logger=None,chroms=[2,5,10],startPos=[25000000, 25000000, 4000000
 		startPos=startPos,
 		numMarkers=numMarkers,
 		mergeSubPops=True,
-		logger=logger)
+		logger=logger,
+		jobs=jobs)
 	if savefiles:
 		initpop.save(savefiles[0])
 		selectMarkers.saveMarkerList(initpop, savefiles[1])
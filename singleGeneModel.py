@@ -13,13 +13,18 @@ The user will need to specify:
 2) The Genotype Relative Risk.
 3) The wild-type risk.
 4) The number of cases and controls. 
+
+Several disease loci can be combined with a multi-locus penetrance model
+(mlPenModel), which is compiled to a table of risks of the 3^n genotypes of
+n disease loci.
 """
 
-import simuOpt, random, math,sys
+import simuOpt, random, math,sys,itertools,time
 simuOpt.setOptions(alleleType='binary', optimized=True)
 from simuPOP import *
 
-import config
+from collections import namedtuple
+from array import array
 
 options = [
 	{'name':'DPL',
@@ -39,6 +44,39 @@ options = [
 	'label':'Wild Type Risk',
 	'validate':simuOpt.valueBetween(0,1)
 	},
+	{'name':'mlPenModel',
+	'default':'none',
+	'type':('chooseOneOf',['none','additive','multiplicative','interaction']),
+	'label':'Multi-locus penetrance model',
+	'description':"""Model of the risk of an offspring given its genotypes at all DPL.
+		none: only the first DPL is used, with risks wtr, wtr*GRR and wtr*GRR*2.
+		multiplicative: wtr*Prod(RR_i), where RR_i is the relative risk at DPL i.
+		additive: wtr*(1+Sum(RR_i-1)).
+		interaction: risks are given by riskTable.
+		Relative risks at each DPL are 1, GRR_i and 2*GRR_i (1 if GRR_i is 1), where
+		GRR_i is given by locusGRR. Risks are truncated at 1."""
+	},
+	{'name':'locusGRR',
+	'default':[],
+	'type':'numbers',
+	'label':'Genotype Relative Risk of each DPL',
+	'description':"""Genotype relative risk of each DPL, used by additive and multiplicative
+		models. GRR is used for all DPL if empty.""",
+	'validate':simuOpt.valueListOf(simuOpt.valueGE(1.0))
+	},
+	{'name':'riskTable',
+	'default':[],
+	'type':'numbers',
+	'label':'Risks of multi-locus genotypes',
+	'description':"""Risks of the 3^n genotypes of n DPL for the interaction model, with
+		genotypes of the first DPL changing the slowest. For example, with two DPL
+		the risks are (by row)
+		    BB Bb bb
+		AA  a1 a2 a3
+		Aa  b1 b2 b3
+		aa  c1 c2 c3""",
+	'validate':simuOpt.valueListOf(simuOpt.valueBetween(0,1))
+	},
 	{'name':'numCases',
 	'default':1000,
 	'type':int,
@@ -60,74 +98,400 @@ options = [
 	'type':str,
 	'label':"Name of sampled population file"
 	},
+	{'name':'maxDraws',
+	'default':100000000,
+	'type':int,
+	'label':"Maximum number of offspring to draw (0 for no limit)",
+	'description':"""Sampling is aborted if the expected number of offspring needed, estimated
+		from allele frequencies of the DPL and the disease model, or the number of
+		offspring drawn exceeds this number.""",
+	'validate':simuOpt.valueGE(0)
+	},
+	{'name':'seed',
+	'default':0,
+	'type':int,
+	'label':"Random seed for sampling (0 for random)",
+	'validate':simuOpt.valueGE(0)
+	},
 	{'name':'pop',
 	'default':'',
 	'description':'simuPOP population object from expandPop'
 	}
 	]
 
+SamplingResult = namedtuple('SamplingResult', ['numCases', 'numControls', 'discarded', 'wildTypeCases', 'mutantControls'])
 
-def _selectInds(off, param):
-	'Deterimine if the offspring can be kept'
-	g1 = off.allele(param[0], 0) + off.allele(param[0], 1)
-	affected = random.random() < config.risks[g1]
-	if affected:
-		if config.SELECTED_CASE < config.numCases:
-			off.setAffected(True)
-			config.SELECTED_CASE += 1
-			if g1 == 0:
-				config.NUM_WT_CASES += 1
-			return True
-	else:
-		if config.SELECTED_CONTROL < config.numControls:
-			config.SELECTED_CONTROL += 1
-			off.setAffected(False)
-			if g1 > 0:
-				config.NUM_MUT_CONTROLS +=1
-			return True
-			
-	config.DISCARDED_INDS += 1
-	return False
 
+def _parentalAlleles(pop, loci):
+	"""
+	Return indexes of males and females in pop, and alleles of their haplotypes at
+	loci, as lists of bytearrays (one for each locus) in which item 2*i+p is the
+	allele on ploidy p of the i-th male or female.
+	"""
+	males, females = [], []
+	maleAlleles = [bytearray() for loc in loci]
+	femaleAlleles = [bytearray() for loc in loci]
+	for idx, ind in enumerate(pop.individuals()):
+		if ind.sex() == MALE:
+			males.append(idx)
+			alleles = maleAlleles
+		else:
+			females.append(idx)
+			alleles = femaleAlleles
+		for loc, locAlleles in zip(loci, alleles):
+			locAlleles.extend([ind.allele(loc, 0), ind.allele(loc, 1)])
+	return males, females, maleAlleles, femaleAlleles
 
+class OffspringPool(object):
+	"""
+	Offspring of random pairs of parents in a population, stored in compact arrays so
+	that the same offspring can be used to sample cases and controls under different
+	disease models. Each parent transmits one random haplotype of each chromosome with
+	loci, so the genotypes of an offspring at loci are formed by these haplotypes.
+	
+	self.loci -- disease loci.
+	self.chroms -- chromosomes of loci, in the order of their first locus.
+	self.fathers, self.mothers -- indexes of parents.
+	self.ploidy -- ploidy of the haplotypes of father plus those of mother shifted by
+		len(self.chroms) bits, where bit j is the ploidy for chromosome self.chroms[j].
+	self.geno -- packed genotype code Sum(g_i*3^(n-1-i)), where g_i is the number of
+		allele 1 at the i-th of n loci.
+	self.uniform -- uniform random numbers used to determine affection status.
+	
+	The pool grows in blocks of blockSize offspring (see reserve), so that offspring
+	in the pool do not depend on how samplers that share the pool extend it.
+	"""
+	blockSize = 10000
+	
+	def __init__(self, pop, loci, seed=None, size=0):
+		"""Create a pool of size offspring of pop, using a random number generator seeded by seed."""
+		if 3 ** len(loci) > 256:
+			raise ValueError('At most 5 disease loci are supported, %d given' % len(loci))
+		self.loci = list(loci)
+		locusChroms = [pop.chromLocusPair(loc)[0] for loc in loci]
+		self.chroms = []
+		for ch in locusChroms:
+			if ch not in self.chroms:
+				self.chroms.append(ch)
+		self._chromIdx = [self.chroms.index(ch) for ch in locusChroms]
+		self.rng = random.Random(seed)
+		self._parents = _parentalAlleles(pop, loci)
+		self.fathers = array('l')
+		self.mothers = array('l')
+		self.ploidy = array('H')
+		self.geno = bytearray()
+		self.uniform = array('d')
+		self.reserve(size)
+	
+	def __len__(self):
+		"""Return the number of offspring in the pool."""
+		return len(self.geno)
+	
+	def reserve(self, size):
+		"""Extend the pool by whole blocks until it has at least size offspring."""
+		while len(self) < size:
+			self.extend(self.blockSize)
+	
+	def genotypeFreqs(self):
+		"""
+		Return the expected frequencies of packed genotype codes of offspring, from
+		allele frequencies of fathers and mothers at each locus, assuming linkage
+		equilibrium between loci.
+		"""
+		males, females, maleAlleles, femaleAlleles = self._parents
+		freqs = [1.]
+		for fAlleles, mAlleles in zip(maleAlleles, femaleAlleles):
+			pf = float(sum(fAlleles)) / max(1, len(fAlleles))
+			pm = float(sum(mAlleles)) / max(1, len(mAlleles))
+			locFreqs = [(1 - pf) * (1 - pm), pf * (1 - pm) + (1 - pf) * pm, pf * pm]
+			freqs = [x * y for x in freqs for y in locFreqs]
+		return freqs
+	
+	def extend(self, size):
+		"""Add size offspring to the pool."""
+		males, females, maleAlleles, femaleAlleles = self._parents
+		numMaleHaps = 2 * len(males)
+		numFemaleHaps = 2 * len(females)
+		numChroms = len(self.chroms)
+		rand = self.rng.random
+		# a haplotype of each parent for the first chromosome, and the ploidy of
+		# other chromosomes as extra bits
+		fHaps = [int(rand() * numMaleHaps) for x in xrange(size)]
+		mHaps = [int(rand() * numFemaleHaps) for x in xrange(size)]
+		fPloidy = [x % 2 for x in fHaps]
+		mPloidy = [x % 2 for x in mHaps]
+		if numChroms > 1:
+			bits = self.rng.getrandbits
+			fPloidy = [x | bits(numChroms - 1) << 1 for x in fPloidy]
+			mPloidy = [x | bits(numChroms - 1) << 1 for x in mPloidy]
+		self.fathers.extend([males[x / 2] for x in fHaps])
+		self.mothers.extend([females[x / 2] for x in mHaps])
+		self.ploidy.extend([x | y << numChroms for x, y in zip(fPloidy, mPloidy)])
+		geno = [0] * size
+		for fAlleles, mAlleles, ch in zip(maleAlleles, femaleAlleles, self._chromIdx):
+			if ch == 0:
+				fIdx, mIdx = fHaps, mHaps
+			else:
+				fIdx = [x - x % 2 + (y >> ch & 1) for x, y in zip(fHaps, fPloidy)]
+				mIdx = [x - x % 2 + (y >> ch & 1) for x, y in zip(mHaps, mPloidy)]
+			geno = [g * 3 + fAlleles[x] + mAlleles[y] for g, x, y in zip(geno, fIdx, mIdx)]
+		self.geno.extend(geno)
+		self.uniform.extend([rand() for x in xrange(size)])
 
-def penetrance(pars,logger=None):
+class CaseControlSampler(object):
 	"""
-	Given a simuPOP population, the relative risk (additive), the wild-type risk, and the number and cases and controls, build a case-control dataset in simuPOP format.
-	DPL must be a list, even if there is only one locus.
+	Rejection sampler of cases and controls from offspring of a population. All
+	states of a sampling, including its random number generator, are kept in the
+	sampler so that several samplers can be used at the same time.
+	
+	self.records -- (father, mother, father ploidy, mother ploidy, affected) of
+		accepted offspring, in the order they are drawn. Bit j of a ploidy is the
+		ploidy of the haplotype for chromosome self.chroms[j].
+	self.chroms -- chromosomes of the disease loci, set by draw().
+	self.result -- a SamplingResult after draw().
 	"""
-	#DPL=["rs4491689", "rs2619939"]
-	reppop = pars.pop.clone()
-	loci = reppop.lociByNames(pars.DPL)
-	#Set risks
-	het_risk = pars.wtr*pars.GRR
-	if pars.GRR > 1:
-		hom_mut_risk = pars.wtr*pars.GRR*2
-	else:
-		hom_mut_risk = pars.wtr
+	# seconds between progress reports
+	reportInterval = 10
+	minBatchSize = 1000
+	maxBatchSize = 1000000
 	
-	config.risks = [pars.wtr,het_risk,hom_mut_risk]
-	config.numCases = pars.numCases
-	config.numControls = pars.numControls
+	def __init__(self, pop, loci, risks, numCases, numControls, seed=None, batchSize=None,
+		pool=None, useUniforms=True, maxDraws=0, logger=None):
+		"""
+		Sample numCases affected and numControls unaffected offspring of random pairs
+		of parents in pop. The genotypes of an offspring at loci are formed by one
+		random haplotype of each parent, and the offspring is affected with probability
+		risks[code], where code is its packed genotype code (see OffspringPool). seed
+		is the seed of the random number generator of the sampler.
+		
+		If an OffspringPool is given, offspring are taken from the beginning of the pool,
+		which is extended if needed. Their affection status is determined by uniform
+		random numbers in the pool (common random numbers for samplers that share the
+		pool) if useUniforms is True, and by the sampler otherwise.
+		
+		Offspring are drawn in batches of batchSize, or of the expected number of
+		offspring needed to complete the sample if batchSize is None. Sampling is
+		aborted with a ValueError if more than maxDraws (if positive) offspring are
+		expected or drawn. Progress is reported to logger.
+		"""
+		if len(risks) != 3 ** len(loci):
+			raise ValueError('%d risks are needed for %d disease loci, %d given' % (3 ** len(loci), len(loci), len(risks)))
+		self.pop = pop
+		self.loci = loci
+		self.risks = risks
+		self.numCases = numCases
+		self.numControls = numControls
+		self.batchSize = batchSize
+		self.rng = random.Random(seed)
+		self.pool = pool
+		self.useUniforms = useUniforms
+		self.maxDraws = maxDraws
+		self.logger = logger
+		self.records = []
+		self.chroms = []
+		self.result = None
 	
-	reppop.evolve(
-		matingScheme=RandomMating(
-			ops=[
-				MendelianGenoTransmitter(),
-				# an individual will be discarded if _selectInds returns False
-				PyOperator(func=_selectInds, param=loci)
-			], 
-			subPopSize=config.numCases + config.numControls
-		),
-		gen = 1
-	)
+	def expectedDraws(self, caseRate, cases=0, controls=0):
+		"""
+		Return the expected number of offspring to draw, with proportion caseRate of
+		affected offspring, to add the cases and controls that are still needed after
+		cases and controls are accepted.
+		"""
+		needed = []
+		if cases < self.numCases:
+			needed.append(caseRate > 0 and (self.numCases - cases) / caseRate or float('inf'))
+		if controls < self.numControls:
+			needed.append(caseRate < 1 and (self.numControls - controls) / (1 - caseRate) or float('inf'))
+		return max(needed + [0])
 	
-	if logger:
-		logger.info("Number of Wild Type Cases: %d" %config.NUM_WT_CASES)
-		logger.info("Number of Mutant Controls: %d" %config.NUM_MUT_CONTROLS)
+	def draw(self):
+		"""
+		Draw offspring in batches until enough cases and controls are accepted. Offspring
+		are accepted in the order they are drawn, as long as there is room for their
+		affection status. Return a SamplingResult.
+		
+		The proportion of affected offspring is estimated from allele frequencies at the
+		disease loci and the risk table before sampling, and from offspring drawn during
+		sampling. It determines the size of batches and the reported time to completion.
+		"""
+		pool = self.pool
+		if pool is None:
+			pool = OffspringPool(self.pop, self.loci, self.rng.getrandbits(32))
+		logger = self.logger
+		rand = self.rng.random
+		risks = self.risks
+		caseRate = sum([x * y for x, y in zip(risks, pool.genotypeFreqs())])
+		expected = self.expectedDraws(caseRate)
+		if logger:
+			logger.info("Expected proportion of affected offspring is %.5f, about %.0f offspring are needed" % (caseRate, expected))
+		if self.maxDraws > 0 and expected > self.maxDraws:
+			raise ValueError('About %.0f offspring are needed to sample %d cases and %d controls, more than %d' \
+				% (expected, self.numCases, self.numControls, self.maxDraws))
+		accepted = []
+		discarded = 0
+		cases = 0
+		controls = 0
+		affectedCount = 0
+		start = 0
+		startTime = lastReport = time.time()
+		while cases < self.numCases or controls < self.numControls:
+			if self.maxDraws > 0 and start >= self.maxDraws:
+				raise ValueError('%d cases and %d controls are sampled after drawing %d offspring, %d and %d needed' \
+					% (cases, controls, start, self.numCases, self.numControls))
+			batchSize = self.batchSize
+			if batchSize is None:
+				batchSize = int(min(self.maxBatchSize, max(self.minBatchSize,
+					1.05 * self.expectedDraws(caseRate, cases, controls))))
+			end = start + batchSize
+			pool.reserve(end)
+			# affection status of offspring in the batch
+			if self.useUniforms:
+				uniform = pool.uniform[start:end]
+			else:
+				uniform = [rand() for x in xrange(batchSize)]
+			affected = [x < risks[g] for x, g in zip(uniform, pool.geno[start:end])]
+			# accept the first cases and controls that are needed
+			caseIdx = [i for i in xrange(batchSize) if affected[i]][:self.numCases - cases]
+			controlIdx = [i for i in xrange(batchSize) if not affected[i]][:self.numControls - controls]
+			cases += len(caseIdx)
+			controls += len(controlIdx)
+			accepted.extend([(start + i, affected[i]) for i in sorted(caseIdx + controlIdx)])
+			if cases == self.numCases and controls == self.numControls:
+				# offspring after the last accepted one are not counted
+				drawn = max(caseIdx + controlIdx) + 1
+			else:
+				drawn = batchSize
+			discarded += drawn - len(caseIdx) - len(controlIdx)
+			affectedCount += sum(affected[:drawn])
+			start = end
+			if affectedCount > 0:
+				caseRate = float(affectedCount) / start
+			now = time.time()
+			if logger and now - lastReport >= self.reportInterval and \
+				(cases < self.numCases or controls < self.numControls):
+				speed = start / max(now - startTime, 1e-6)
+				logger.info("%d offspring drawn (%.0f per second), acceptance rate %.5f, %d/%d cases, %d/%d controls, ETA %.0f seconds" \
+					% (start, speed, float(cases + controls) / start, cases, self.numCases, controls, self.numControls,
+					self.expectedDraws(caseRate, cases, controls) / speed))
+				lastReport = now
+		numChroms = len(pool.chroms)
+		mask = (1 << numChroms) - 1
+		self.records = [(pool.fathers[k], pool.mothers[k], pool.ploidy[k] & mask, pool.ploidy[k] >> numChroms, aff)
+			for k, aff in accepted]
+		self.chroms = pool.chroms
+		self.result = SamplingResult(cases, controls, discarded,
+			len([1 for k, aff in accepted if aff and pool.geno[k] == 0]),
+			len([1 for k, aff in accepted if not aff and pool.geno[k] > 0]))
+		if logger:
+			drawn = len(accepted) + discarded
+			logger.info("%d offspring drawn in %.1f seconds, acceptance rate %.5f" \
+				% (drawn, time.time() - startTime, float(len(accepted)) / max(1, drawn)))
+		return self.result
 	
-	config.SELECTED_CASE,config.SELECTED_CONTROL,config.DISCARDED_INDS,config.NUM_WT_CASES,config.NUM_MUT_CONTROLS = config.reset()
-	return reppop
+	def materialize(self):
+		"""
+		Return a new population of accepted offspring, with the genetic structure of the
+		sampled population. Each chromosome of an offspring is a copy of one chromosome of
+		each parent, the one on the drawn ploidy for chromosomes of the sampled loci and
+		a random one for other chromosomes. Parental genotypes are read in place, so
+		the sampled population is neither copied nor changed.
+		"""
+		pop = self.pop
+		randint = self.rng.randint
+		dplChroms = dict([(ch, j) for j, ch in enumerate(self.chroms)])
+		numChrom = pop.numChrom()
+		reppop = Population(size=len(self.records), ploidy=2, loci=pop.numLoci(),
+			lociPos=pop.lociPos(), lociNames=pop.lociNames(), chromNames=pop.chromNames(),
+			alleleNames=[pop.alleleNames(x) for x in xrange(pop.totNumLoci())],
+			infoFields=pop.infoFields())
+		reppop.vars().update(pop.vars())
+		for off, rec in zip(reppop.individuals(), self.records):
+			dad = pop.individual(rec[0])
+			mom = pop.individual(rec[1])
+			for ch in range(numChrom):
+				if ch in dplChroms:
+					j = dplChroms[ch]
+					fPloidy, mPloidy = rec[2] >> j & 1, rec[3] >> j & 1
+				else:
+					fPloidy, mPloidy = randint(0, 1), randint(0, 1)
+				off.setGenotype(dad.genotype(fPloidy, ch), 0, ch)
+				off.setGenotype(mom.genotype(mPloidy, ch), 1, ch)
+			off.setSex(randint(0, 1) and FEMALE or MALE)
+			off.setAffected(rec[4])
+		return reppop
+
+def _relativeRisks(GRR):
+	"""Return relative risks of genotypes with 0, 1 and 2 disease alleles at a locus."""
+	if GRR > 1:
+		return [1, GRR, GRR*2]
+	return [1, GRR, 1]
+
+def diseaseLoci(pars):
+	"""Return indexes of the disease loci of pars.pop used by pars.mlPenModel."""
+	loci = pars.pop.lociByNames(pars.DPL)
+	if pars.mlPenModel == 'none':
+		return loci[:1]
+	return list(loci)
+
+def diseaseRisks(pars):
+	"""
+	Return the risk table of pars.mlPenModel, namely the risks of the 3^n genotypes of
+	n disease loci, indexed by packed genotype codes (see OffspringPool). Without a
+	multi-locus model, these are the risks of genotypes with 0, 1 and 2 disease alleles
+	at the first DPL.
+	"""
+	if pars.mlPenModel == 'none':
+		return [pars.wtr*x for x in _relativeRisks(pars.GRR)]
+	numDPL = len(pars.DPL)
+	if pars.mlPenModel == 'interaction':
+		if len(pars.riskTable) != 3**numDPL:
+			raise ValueError("Please specify 3^n risks for n DPL")
+		return list(pars.riskTable)
+	if len(pars.locusGRR) == 0:
+		GRRs = [pars.GRR]*numDPL
+	elif len(pars.locusGRR) == numDPL:
+		GRRs = pars.locusGRR
+	else:
+		raise ValueError("Please specify GRR for each DPL")
+	locusRisks = [_relativeRisks(x) for x in GRRs]
+	risks = []
+	for geno in itertools.product(range(3), repeat=numDPL):
+		RRs = [r[g] for r, g in zip(locusRisks, geno)]
+		if pars.mlPenModel == 'multiplicative':
+			RR = reduce(lambda x, y: x*y, RRs, 1.)
+		else:
+			RR = 1 + sum([x - 1 for x in RRs])
+		risks.append(min(1., pars.wtr*RR))
+	return risks
+
+def sampleCaseControl(pars,logger=None,pool=None,useUniforms=True):
+	"""
+	Given a simuPOP population, the relative risk (additive), the wild-type risk, and the
+	number and cases and controls, build a case-control dataset in simuPOP format. Return
+	the dataset and a SamplingResult.
+	
+	Offspring of random parents are drawn in batches and accepted as cases or controls
+	according to their genotypes at the DPL of pars.mlPenModel (rejection sampling). Only accepted
+	offspring are created in the returned population, and pars.pop is not copied. If an OffspringPool of pars.pop
+	is given, offspring are taken from it (see CaseControlSampler).
+	"""
+	sampler = CaseControlSampler(pars.pop, diseaseLoci(pars), diseaseRisks(pars), pars.numCases,
+		pars.numControls, seed=pars.seed or None, pool=pool, useUniforms=useUniforms,
+		maxDraws=pars.maxDraws, logger=logger)
+	result = sampler.draw()
+	reppop = sampler.materialize()
+	if logger:
+		logger.info("Number of Wild Type Cases: %d" %result.wildTypeCases)
+		logger.info("Number of Mutant Controls: %d" %result.mutantControls)
+		logger.info("Number of Discarded Offspring: %d" %result.discarded)
+	return reppop, result
+
+def penetrance(pars,logger=None):
+	"""
+	Given a simuPOP population, the relative risk (additive), the wild-type risk, and the number and cases and controls, build a case-control dataset in simuPOP format.
+	DPL must be a list, even if there is only one locus.
+	"""
+	return sampleCaseControl(pars,logger)[0]
 
 if __name__=='__main__':
 	import logging